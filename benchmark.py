@@ -0,0 +1,358 @@
+"""
+Benchmark harness for the patient lookup path
+Drives recept.get_patient_full in-process or the GetPatient ACP endpoint at a fixed
+concurrency and reports latency percentiles and throughput; also compares
+textbook retrieval quality (recall@k) of vector-only and hybrid search
+
+    python benchmark.py patient --db hospital.db --concurrency 16 --requests 5000
+    python benchmark.py patient --acp http://localhost:8003 --concurrency 64
+    python benchmark.py codec --parts 500 --part-size 1024
+    python benchmark.py retrieval --index textbook_index --queries labelled_queries.jsonl --k 8
+    python benchmark.py retrieval --index textbook_index --synthetic 500 --noise 1.0
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ============================================================================
+# REPORTING
+# ============================================================================
+
+def percentile(sorted_values, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def summarize(name: str, latencies, wall_seconds: float, errors: int = 0) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "benchmark": name,
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_per_s": round(len(ordered) / wall_seconds, 1) if wall_seconds else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0
+    }
+
+def print_report(report: dict):
+    print("\n" + "="*80)
+    print(f"📊 {report['benchmark']}")
+    print("="*80)
+    for key, value in report.items():
+        if key != "benchmark":
+            print(f"  {key:<20} {value}")
+    print("="*80)
+
+# ============================================================================
+# WORKLOAD
+# ============================================================================
+
+def _typo(name: str, rng: random.Random) -> str:
+    """Swap two adjacent letters of one name token"""
+    tokens = name.split()
+    i = rng.randrange(len(tokens))
+    token = tokens[i]
+    if len(token) > 3:
+        j = rng.randrange(1, len(token) - 2)
+        tokens[i] = token[:j] + token[j + 1] + token[j] + token[j + 2:]
+    return " ".join(tokens)
+
+def sample_queries(db_path: str, count: int, miss_rate: float = 0.05, typo_rate: float = 0.05,
+                   seed: int = 7) -> list:
+    """Lookup names drawn from the database, with some misses and typos mixed in"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    max_id = conn.execute("SELECT MAX(patient_id) FROM patients").fetchone()[0] or 0
+    ids = [rng.randint(1, max_id) for _ in range(min(count, 10000))] if max_id else []
+    names = []
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        names.extend(row[0] for row in conn.execute(
+            f"SELECT patient_name FROM patients WHERE patient_id IN ({','.join('?' * len(chunk))})",
+            chunk
+        ))
+    conn.close()
+    if not names:
+        raise SystemExit(f"❌ No patients in {db_path} (try generate_db.py first)")
+
+    queries = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < miss_rate:
+            queries.append(f"Nobody Zzyzx{rng.randint(0, 10**6)}")
+        elif roll < miss_rate + typo_rate:
+            queries.append(_typo(rng.choice(names), rng))
+        else:
+            queries.append(rng.choice(names))
+    return queries
+
+# ============================================================================
+# PATIENT LOOKUP BENCHMARKS
+# ============================================================================
+
+def bench_direct(queries: list, concurrency: int) -> dict:
+    """Call recept.get_patient_full from ``concurrency`` threads"""
+    import recept
+
+    def timed(query):
+        started = time.perf_counter()
+        result = recept.get_patient_full(query)
+        return time.perf_counter() - started, "error" in result
+
+    # Warm the pool/indexes so setup is not counted
+    recept.get_patient_full(queries[0])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, queries))
+    wall = time.perf_counter() - started
+
+    report = summarize(f"get_patient_full (concurrency={concurrency})", [r[0] for r in results], wall)
+    report["not_found"] = sum(1 for r in results if r[1])
+    report["shards"] = recept.get_router().stats()
+    report["cache"] = recept.patient_cache.stats()
+    return report
+
+async def _bench_acp(base_url: str, queries: list, concurrency: int) -> dict:
+    from acp_sdk.client import Client
+    from acp_sdk.models import Message, MessagePart
+    from codec import accept_part
+
+    latencies = []
+    errors = 0
+    pending = iter(queries)
+
+    async with Client(base_url=base_url) as client:
+        async def worker():
+            nonlocal errors
+            for query in pending:
+                started = time.perf_counter()
+                try:
+                    await client.run_sync(
+                        agent="GetPatient",
+                        input=[Message(parts=[MessagePart(content=query, content_type="text/plain"), accept_part()])]
+                    )
+                    latencies.append(time.perf_counter() - started)
+                except Exception:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+
+    return summarize(f"ACP GetPatient @ {base_url} (concurrency={concurrency})", latencies, wall, errors)
+
+def bench_acp(base_url: str, queries: list, concurrency: int) -> dict:
+    return asyncio.run(_bench_acp(base_url, queries, concurrency))
+
+def run_patient(args):
+    import recept
+    if args.db:
+        recept.DB_PATH = args.db
+    if args.no_cache:
+        recept.patient_cache.max_size = 0
+    if not args.acp:
+        recept.init_databases()
+
+    queries = sample_queries(recept.DB_PATH, args.requests, args.miss_rate, args.typo_rate, args.seed)
+    if args.acp:
+        report = bench_acp(args.acp, queries, args.concurrency)
+    else:
+        report = bench_direct(queries, args.concurrency)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+# ============================================================================
+# CODEC BENCHMARKS
+# ============================================================================
+
+def _legacy_extract_text(input_obj) -> str:
+    """The per-service extractor codec.decode_input replaced (hasattr chains, +=)"""
+    from codec import is_control_part
+    text = ""
+    if isinstance(input_obj, list):
+        for msg in input_obj:
+            if hasattr(msg, 'parts') and msg.parts:
+                for part in msg.parts:
+                    if hasattr(part, 'content') and part.content and not is_control_part(part):
+                        text += str(part.content) + " "
+    elif hasattr(input_obj, 'parts') and input_obj.parts:
+        for part in input_obj.parts:
+            if hasattr(part, 'content') and part.content and not is_control_part(part):
+                text += str(part.content) + " "
+    elif hasattr(input_obj, 'content'):
+        text = str(input_obj.content)
+    return text.strip()
+
+def _time_per_call(fn, arg, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - started) / iterations
+
+def run_codec(args):
+    from acp_sdk.models import Message, MessagePart
+    from codec import accept_part, decode_input
+
+    rng = random.Random(args.seed)
+    words = ["kidney", "creatinine", "dialysis", "potassium", "eGFR", "sodium", "renal", "diet"]
+    parts = [
+        MessagePart(
+            content=" ".join(rng.choice(words) for _ in range(args.part_size // 8)),
+            content_type="text/plain"
+        )
+        for _ in range(args.parts)
+    ]
+    message = [Message(parts=parts[:len(parts) // 2]), Message(parts=parts[len(parts) // 2:] + [accept_part()])]
+
+    # Same text either way, so the timings compare like with like
+    assert _legacy_extract_text(message).split() == decode_input(message).text.split()
+    legacy = _time_per_call(_legacy_extract_text, message, args.iterations)
+    shared = _time_per_call(decode_input, message, args.iterations)
+
+    report = {
+        "benchmark": f"ACP input decoding ({args.parts} parts x ~{args.part_size} chars)",
+        "iterations": args.iterations,
+        "legacy_us_per_call": round(legacy * 1e6, 1),
+        "codec_us_per_call": round(shared * 1e6, 1),
+        "speedup": round(legacy / shared, 2) if shared else 0.0
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+# ============================================================================
+# RETRIEVAL BENCHMARKS
+# ============================================================================
+
+def load_labelled_queries(path: str) -> list:
+    """{"query", "relevant": [chunk ids], "vector"?} per line; missing vectors
+    are embedded through research.py (and its embedding cache)"""
+    with open(path, encoding="utf-8") as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+    if any("vector" not in q for q in queries):
+        from research import generate_embeddings, get_clients
+        openai_client = get_clients().openai
+        for q in queries:
+            if "vector" not in q:
+                q["vector"] = generate_embeddings(q["query"], openai_client)
+    return queries
+
+def synthetic_queries(index, count: int, noise: float, terms: int, seed: int) -> list:
+    """One query per sampled chunk: its vector plus Gaussian noise (``noise``
+    is the noise norm relative to the unit vector) and its ``terms`` rarest
+    words as the text. The chunk itself is the only relevant result."""
+    import numpy as np
+    from local_index import tokenize
+    rng = np.random.default_rng(seed)
+    bm25 = index.bm25
+    postings = lambda term: bm25.offsets[bm25.terms[term] + 1] - bm25.offsets[bm25.terms[term]]
+    queries = []
+    for row in rng.choice(index.count, min(count, index.count), replace=False):
+        chunk = index.chunks[row]
+        words = sorted(set(tokenize(chunk["content"])), key=postings)[:terms]
+        vector = np.asarray(index.vectors[row]) + rng.standard_normal(index.dim) * noise / index.dim ** 0.5
+        queries.append({"query": " ".join(words), "relevant": [chunk["id"]], "vector": vector})
+    return queries
+
+def _bench_search(name: str, search, queries: list, k: int) -> dict:
+    latencies, recall = [], 0.0
+    for q in queries:
+        started = time.perf_counter()
+        results = search(q)
+        latencies.append(time.perf_counter() - started)
+        found = {r["id"] for r in results[:k]}
+        recall += len(found.intersection(q["relevant"])) / len(q["relevant"])
+    ordered = sorted(latencies)
+    return {
+        "benchmark": name,
+        "queries": len(queries),
+        f"recall@{k}": round(recall / len(queries), 4) if queries else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0
+    }
+
+def run_retrieval(args):
+    from local_index import LocalIndex
+    index = LocalIndex(args.index, nprobe=args.nprobe)
+    if args.queries:
+        queries = load_labelled_queries(args.queries)
+    else:
+        queries = synthetic_queries(index, args.synthetic, args.noise, args.terms, args.seed)
+    queries = [q for q in queries if q.get("relevant")]
+    if not queries:
+        raise SystemExit("❌ No queries with relevant chunk ids")
+    index.bm25  # load before timing
+
+    reports = [
+        _bench_search("vector only", lambda q: index.search(q["vector"], args.k), queries, args.k),
+        _bench_search("hybrid (BM25 + vector, RRF, rerank)",
+                      lambda q: index.hybrid_search(q["vector"], q["query"], args.k, term_weight=args.term_weight),
+                      queries, args.k)
+    ]
+    for report in reports:
+        print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Nephrology AI benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    patient = sub.add_parser("patient", help="Patient lookup latency/throughput")
+    patient.add_argument("--db", help="hospital.db to query (default: recept.DB_PATH)")
+    patient.add_argument("--acp", help="Benchmark the GetPatient endpoint at this base URL instead")
+    patient.add_argument("--concurrency", type=int, default=16)
+    patient.add_argument("--requests", type=int, default=5000)
+    patient.add_argument("--miss-rate", type=float, default=0.05, help="Fraction of unknown names")
+    patient.add_argument("--typo-rate", type=float, default=0.05, help="Fraction of misspelled names")
+    patient.add_argument("--no-cache", action="store_true", help="Disable the record cache (direct mode)")
+    patient.add_argument("--seed", type=int, default=7)
+    patient.add_argument("--json", help="Also write the report to this file")
+    patient.set_defaults(func=run_patient)
+
+    codec_parser = sub.add_parser("codec", help="ACP message decoding micro-benchmark")
+    codec_parser.add_argument("--parts", type=int, default=500, help="Message parts per input")
+    codec_parser.add_argument("--part-size", type=int, default=1024, help="Approximate characters per part")
+    codec_parser.add_argument("--iterations", type=int, default=200)
+    codec_parser.add_argument("--seed", type=int, default=7)
+    codec_parser.add_argument("--json", help="Also write the report to this file")
+    codec_parser.set_defaults(func=run_codec)
+
+    retrieval = sub.add_parser("retrieval", help="Recall@k and latency, vector-only vs hybrid (local index)")
+    retrieval.add_argument("--index", default="textbook_index", help="Directory written by local_index.py")
+    source = retrieval.add_mutually_exclusive_group(required=True)
+    source.add_argument("--queries", help="JSONL with query, relevant chunk ids and optionally vector")
+    source.add_argument("--synthetic", type=int, help="Generate this many queries from the index itself")
+    retrieval.add_argument("--noise", type=float, default=1.0, help="Synthetic query vector noise")
+    retrieval.add_argument("--terms", type=int, default=3, help="Rarest chunk words per synthetic query")
+    retrieval.add_argument("--k", type=int, default=8)
+    retrieval.add_argument("--nprobe", type=int, default=8)
+    retrieval.add_argument("--term-weight", type=float, default=0.3, help="Rerank weight of query-term coverage")
+    retrieval.add_argument("--seed", type=int, default=7)
+    retrieval.add_argument("--json", help="Also write the reports to this file")
+    retrieval.set_defaults(func=run_retrieval)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Caches for the nephrology chatbot's external calls
+Keeps repeat work (embeddings of the same disease name, web searches for the
+same question, ...) off the network, in memory or on disk across restarts
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger("caches")
+
+# What a cache file can raise: locked, disk full, corrupt, unwritable directory.
+# None of these should fail the lookup the cache sits in front of.
+CACHE_ERRORS = (sqlite3.Error, OSError)
+
+def normalize_text(text: str) -> str:
+    """Cache key form of a query: Unicode-normalized, case-folded, single-spaced"""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def _open_sqlite(path: str, schema: str) -> sqlite3.Connection:
+    """WAL connection to a cache file, creating its directory and tables"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    return conn
+
+# ============================================================================
+# EMBEDDINGS
+# ============================================================================
+
+EMBEDDING_STORE_SQL = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    text_key TEXT NOT NULL,
+    dim INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (model, text_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_embeddings_created ON embeddings(created_at);
+"""
+
+class EmbeddingStore:
+    """Persistent (model, text) → float32 vector table in SQLite.
+
+    Vectors are stored as raw float32 blobs (4 bytes per dimension). When
+    the table grows past ``max_rows`` the oldest entries are deleted. The
+    file is created on first use, not when the store is constructed.
+    """
+
+    def __init__(self, path: str, max_rows: int = 100000):
+        self.path = path
+        self.max_rows = max_rows
+        self.evictions = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._rows = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # Callers hold self._lock
+        if self._conn is None:
+            self._conn = _open_sqlite(self.path, EMBEDDING_STORE_SQL)
+            self._rows = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self._conn
+
+    def get(self, model: str, text_key: str) -> Optional[array]:
+        """Stored vector, or None when absent or the file cannot be read"""
+        with self._lock:
+            try:
+                row = self._db().execute(
+                    "SELECT vector FROM embeddings WHERE model = ? AND text_key = ?", (model, text_key)
+                ).fetchone()
+            except CACHE_ERRORS as e:
+                self.errors += 1
+                logger.debug("Embedding cache read failed (%s): %s", self.path, e)
+                return None
+        if row is None:
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector
+
+    def put(self, model: str, text_key: str, vector: array):
+        """Store a vector; a write that fails is logged and dropped"""
+        with self._lock:
+            try:
+                self._put(model, text_key, vector)
+            except CACHE_ERRORS as e:
+                self.errors += 1
+                logger.warning("Embedding cache write failed (%s): %s", self.path, e)
+
+    def _put(self, model: str, text_key: str, vector: array):
+        # Caller holds self._lock
+        inserted = self._db().execute(
+            "INSERT OR IGNORE INTO embeddings(model, text_key, dim, vector, created_at) VALUES (?, ?, ?, ?, ?)",
+            (model, text_key, len(vector), vector.tobytes(), time.time())
+        ).rowcount
+        self._rows += inserted
+        if self._rows > self.max_rows:
+            # Trim to 90% in one statement so this does not run on every insert
+            excess = self._rows - int(self.max_rows * 0.9)
+            deleted = self._conn.execute(
+                "DELETE FROM embeddings WHERE (model, text_key) IN "
+                "(SELECT model, text_key FROM embeddings ORDER BY created_at LIMIT ?)", (excess,)
+            ).rowcount
+            self._rows -= deleted
+            self.evictions += deleted
+
+    def __len__(self) -> int:
+        """Rows on disk (0 until the file is first opened)"""
+        return self._rows
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class EmbeddingCache:
+    """Two-tier embedding cache: in-memory LRU in front of an ``EmbeddingStore``.
+
+    Keys are (model, normalized text), so "CKD", "ckd " and "Ckd" share one
+    entry. A disk hit is promoted into memory. Pass ``store=None`` for a
+    memory-only cache.
+    """
+
+    def __init__(self, max_size: int = 1024, store: Optional[EmbeddingStore] = None):
+        self.max_size = max_size
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self, key, vector: array):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = (model, normalize_text(text))
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return vector.tolist()
+        if self.store is not None:
+            vector = self.store.get(*key)
+            if vector is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(key, vector)
+                return vector.tolist()
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        key = (model, normalize_text(text))
+        vector = array("f", embedding)
+        self._remember(key, vector)
+        if self.store is not None:
+            self.store.put(*key, vector)
+
+    def get_or_compute(self, model: str, text: str, compute: Callable[[str], List[float]]) -> List[float]:
+        """Cached embedding of ``text``, calling ``compute(text)`` only on a miss"""
+        embedding = self.get(model, text)
+        if embedding is None:
+            embedding = compute(text)
+            self.put(model, text, embedding)
+        return embedding
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "disk_entries": len(self.store) if self.store is not None else None,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "disk_evictions": self.store.evictions if self.store is not None else 0,
+                "disk_errors": self.store.errors if self.store is not None else 0
+            }
+
+# ============================================================================
+# WEB SEARCH RESULTS
+# ============================================================================
+
+WEB_RESULTS_SQL = """
+CREATE TABLE IF NOT EXISTS web_results (
+    query_key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_web_results_expires ON web_results(expires_at);
+"""
+
+WORD_RE = re.compile(r"\w+")
+
+def web_query_key(query: str, disease: str = "") -> str:
+    """Disease plus the sorted, de-duplicated query terms, so "CKD latest
+    guidelines" and "latest CKD guidelines?" share one entry"""
+    terms = sorted(set(WORD_RE.findall(normalize_text(query))))
+    return f"{normalize_text(disease or '')}|{' '.join(terms)}"
+
+class WebResultCache:
+    """Persistent query key → JSON value cache with a TTL per entry.
+
+    Expired entries count as misses and are deleted when read. Past
+    ``max_entries`` the expired entries go first, then the ones closest
+    to expiring. The file is created on first use.
+    """
+
+    def __init__(self, path: str, ttl: float = 86400, max_entries: int = 10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._rows = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # Callers hold self._lock
+        if self._conn is None:
+            self._conn = _open_sqlite(self.path, WEB_RESULTS_SQL)
+            self._rows = self._conn.execute("SELECT COUNT(*) FROM web_results").fetchone()[0]
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """Cached value, or None when absent, expired or unreadable"""
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db().execute(
+                    "SELECT value, expires_at FROM web_results WHERE query_key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] <= now:
+                    self._rows -= self._conn.execute("DELETE FROM web_results WHERE query_key = ?", (key,)).rowcount
+                    self.expirations += 1
+                    row = None
+            except CACHE_ERRORS as e:
+                self.errors += 1
+                logger.debug("Web result cache read failed (%s): %s", self.path, e)
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a value; a write that fails is logged and dropped"""
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        encoded = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            try:
+                existed = self._db().execute("SELECT 1 FROM web_results WHERE query_key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO web_results(query_key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, encoded, expires_at)
+                )
+                if not existed:
+                    self._rows += 1
+                if self._rows > self.max_entries:
+                    self._evict()
+            except CACHE_ERRORS as e:
+                self.errors += 1
+                logger.warning("Web result cache write failed (%s): %s", self.path, e)
+
+    def _evict(self):
+        self._rows -= self._conn.execute("DELETE FROM web_results WHERE expires_at <= ?", (time.time(),)).rowcount
+        excess = self._rows - int(self.max_entries * 0.9)
+        if excess > 0:
+            deleted = self._conn.execute(
+                "DELETE FROM web_results WHERE query_key IN "
+                "(SELECT query_key FROM web_results ORDER BY expires_at LIMIT ?)", (excess,)
+            ).rowcount
+            self._rows -= deleted
+            self.evictions += deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._rows,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "errors": self.errors
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
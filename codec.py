@@ -0,0 +1,219 @@
+"""
+ACP wire codec shared by the agent servers and their clients
+Minified JSON by default (orjson when installed), msgpack when the client asks for it
+"""
+
+import base64
+import json
+import os
+from dataclasses import dataclass, field
+
+from acp_sdk.models import MessagePart
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+# ============================================================================
+# CONTENT TYPES
+# ============================================================================
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+TEXT_CONTENT_TYPE = "text/plain"
+
+# A request may carry one extra part named "accept" whose content_type is the
+# encoding the client wants back. Servers fall back to JSON for anything else.
+ACCEPT_PART_NAME = "accept"
+
+# Encoding clients ask for (JSON unless overridden and msgpack is installed)
+PREFERRED_CONTENT_TYPE = os.getenv("ACP_WIRE_FORMAT", JSON_CONTENT_TYPE)
+
+# ============================================================================
+# JSON
+# ============================================================================
+
+def dumps_json(obj) -> str:
+    """Minified JSON text; non-ASCII is kept as-is"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def loads_json(text):
+    """Parse JSON from str or bytes (orjson reads either without a copy)"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(text)
+    return json.loads(text)
+
+# ============================================================================
+# NEGOTIATION
+# ============================================================================
+
+def accept_part(content_type: str = None) -> MessagePart:
+    """Control part a client appends to its request to pick the response encoding"""
+    content_type = content_type or PREFERRED_CONTENT_TYPE
+    return MessagePart(name=ACCEPT_PART_NAME, content=content_type, content_type=content_type)
+
+def is_control_part(part) -> bool:
+    return getattr(part, "name", None) == ACCEPT_PART_NAME
+
+def _accepted(part) -> str:
+    if part.content_type == MSGPACK_CONTENT_TYPE and MSGPACK_AVAILABLE:
+        return MSGPACK_CONTENT_TYPE
+    return JSON_CONTENT_TYPE
+
+def negotiate(input_obj) -> str:
+    """Response content type requested by the caller's accept part"""
+    for part in _iter_parts(input_obj):
+        if is_control_part(part):
+            return _accepted(part)
+    return JSON_CONTENT_TYPE
+
+# ============================================================================
+# ENCODE / DECODE
+# ============================================================================
+
+def encode_part(obj, content_type: str = JSON_CONTENT_TYPE) -> MessagePart:
+    """Serialize an agent result into a single response part"""
+    if content_type == MSGPACK_CONTENT_TYPE and MSGPACK_AVAILABLE:
+        packed = msgpack.packb(obj, use_bin_type=True)
+        return MessagePart(
+            content=base64.b64encode(packed).decode("ascii"),
+            content_type=MSGPACK_CONTENT_TYPE,
+            content_encoding="base64"
+        )
+    return MessagePart(content=dumps_json(obj), content_type=JSON_CONTENT_TYPE)
+
+def _unpack_msgpack(content):
+    if isinstance(content, str):
+        content = base64.b64decode(content)
+    return msgpack.unpackb(content, raw=False)
+
+def _loads_ndjson(content) -> list:
+    if isinstance(content, bytes):
+        content = content.decode("utf-8")
+    return [loads_json(line) for line in content.splitlines() if line.strip()]
+
+# Structured content types and their decoders; anything else is text
+DECODERS = {
+    JSON_CONTENT_TYPE: loads_json,
+    NDJSON_CONTENT_TYPE: _loads_ndjson,
+}
+if MSGPACK_AVAILABLE:
+    DECODERS[MSGPACK_CONTENT_TYPE] = _unpack_msgpack
+
+def _content_type(part) -> str:
+    content_type = part.content_type or TEXT_CONTENT_TYPE
+    if ";" in content_type:
+        content_type = content_type.split(";", 1)[0].strip()
+    return content_type
+
+def is_text_part(part) -> bool:
+    """Plain text (e.g. a streamed answer delta), to be used as-is rather than decoded"""
+    return _content_type(part) == TEXT_CONTENT_TYPE and not is_control_part(part)
+
+def decode_part(part):
+    """Inverse of ``encode_part``; plain text parts come back as str"""
+    content = part.content
+    if content is None:
+        return None
+    decoder = DECODERS.get(_content_type(part))
+    if decoder:
+        return decoder(content)
+    # Older servers answer with JSON typed as text/plain
+    try:
+        return loads_json(content)
+    except ValueError:
+        return content
+
+def decode_response(resp):
+    """Decode the first output part of an ACP run, or None if there is none"""
+    if not resp or not resp.output or not resp.output[0].parts:
+        return None
+    return decode_part(resp.output[0].parts[0])
+
+# ============================================================================
+# REQUEST DECODING
+# ============================================================================
+
+@dataclass
+class Payload:
+    """Everything an agent needs from its ACP input, decoded in one pass.
+
+    ``text`` joins the plain-text parts in order, ``data`` holds the decoded
+    JSON/msgpack/NDJSON parts and ``accept`` is the negotiated response type.
+    """
+    text: str = ""
+    data: list = field(default_factory=list)
+    accept: str = JSON_CONTENT_TYPE
+
+    def structured(self):
+        """The first structured part, or the text itself when it is JSON"""
+        if self.data:
+            return self.data[0]
+        if self.text[:1] in ("{", "["):
+            try:
+                return loads_json(self.text)
+            except ValueError:
+                pass
+        return None
+
+def _iter_parts(input_obj):
+    """MessageParts of a Message, a list of Messages, or a bare part"""
+    if isinstance(input_obj, list):
+        for msg in input_obj:
+            yield from _iter_parts(msg)
+        return
+    parts = getattr(input_obj, "parts", None)
+    if parts is not None:
+        yield from parts
+    elif getattr(input_obj, "content", None) is not None:
+        yield input_obj
+
+def decode_input(input_obj) -> Payload:
+    """Decode an agent's input into a ``Payload`` (plain strings and dicts too)"""
+    if isinstance(input_obj, str):
+        return Payload(text=input_obj.strip())
+    if isinstance(input_obj, dict):
+        return Payload(data=[input_obj])
+    if isinstance(input_obj, list):
+        part_lists = [getattr(msg, "parts", None) or () for msg in input_obj]
+    elif getattr(input_obj, "parts", None) is not None:
+        part_lists = [input_obj.parts]
+    else:
+        part_lists = [[input_obj]] if getattr(input_obj, "content", None) is not None else []
+
+    payload = Payload()
+    texts = []
+    for parts in part_lists:
+        for part in parts:
+            content = part.content
+            if not content:
+                continue
+            content_type = part.content_type
+            # Plain text is by far the common case: no lookups beyond this
+            if content_type == TEXT_CONTENT_TYPE and part.name is None:
+                texts.append(content)
+                continue
+            if part.name == ACCEPT_PART_NAME:
+                payload.accept = _accepted(part)
+                continue
+            decoder = DECODERS.get(_content_type(part))
+            if decoder is not None:
+                try:
+                    payload.data.append(decoder(content))
+                    continue
+                except ValueError:
+                    pass  # Mislabelled part: keep what the caller sent as text
+            texts.append(content if isinstance(content, str) else str(content))
+    payload.text = " ".join(texts).strip()
+    return payload
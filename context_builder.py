@@ -0,0 +1,128 @@
+"""
+Token-budgeted prompt assembly for the nephrology chatbot
+Counts tokens (tiktoken when installed, an estimate otherwise), drops duplicate
+and near-duplicate chunks, and packs whole chunks in rank order under a budget
+"""
+
+import math
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Context windows by deployment/model name prefix (longest prefix wins)
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1000000,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-35-turbo": 16385,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Chat format overhead: tokens per message, and priming for the reply
+MESSAGE_OVERHEAD = 4
+REPLY_PRIMING = 3
+
+# ============================================================================
+# COUNTING
+# ============================================================================
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    """tiktoken encoding for ``model``, or None to use the estimate.
+
+    tiktoken downloads its BPE files on first use; when that fails (offline
+    or firewalled host) the None is cached too, so it is not retried per call.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Azure deployment names are not model names
+            return tiktoken.get_encoding("o200k_base" if "4o" in model or "4.1" in model else "cl100k_base")
+    except Exception as e:
+        print(f"⚠️  tiktoken encoding for {model} unavailable, estimating tokens: {e}")
+        return None
+
+def count_tokens(text: str, model: str) -> int:
+    """Tokens in ``text`` for ``model`` (about 4 characters each without tiktoken)"""
+    if not text:
+        return 0
+    encoding = _encoding(model) if TIKTOKEN_AVAILABLE else None
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / 4)
+
+def message_tokens(content: str, model: str) -> int:
+    return count_tokens(content, model) + MESSAGE_OVERHEAD
+
+def prompt_budget(model: str, requested: int, max_output: int) -> int:
+    """``requested`` prompt tokens, capped so the answer still fits the model's window"""
+    window = DEFAULT_CONTEXT_WINDOW
+    for prefix in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(prefix):
+            window = MODEL_CONTEXT_WINDOWS[prefix]
+            break
+    return max(0, min(requested, window - max_output))
+
+# ============================================================================
+# DEDUPLICATION
+# ============================================================================
+
+def _shingles(text: str, size: int = 3) -> frozenset:
+    words = text.lower().split()
+    if len(words) <= size:
+        return frozenset([" ".join(words)])
+    return frozenset(" ".join(words[i:i + size]) for i in range(len(words) - size + 1))
+
+def dedupe_chunks(chunks: Sequence[str], seen: Sequence[str] = (), threshold: float = 0.8) -> Tuple[List[str], int]:
+    """Chunks in order without those whose word 3-shingles overlap an earlier
+    chunk (or one of ``seen``) by ``threshold`` Jaccard or more.
+    Returns (kept, number dropped)."""
+    kept, kept_shingles = [], [_shingles(c) for c in seen]
+    dropped = 0
+    for chunk in chunks:
+        shingles = _shingles(chunk)
+        if any(len(shingles & other) >= threshold * len(shingles | other) for other in kept_shingles):
+            dropped += 1
+            continue
+        kept.append(chunk)
+        kept_shingles.append(shingles)
+    return kept, dropped
+
+# ============================================================================
+# PACKING
+# ============================================================================
+
+def pack_chunks(chunks: Sequence[str], budget: int, model: str, overhead: int = 0) -> Tuple[List[str], int, int]:
+    """Whole chunks in rank order while they fit in ``budget`` tokens; a chunk
+    that does not fit is skipped and smaller later ones may still go in.
+    ``overhead`` is added per chunk (separators, numbering).
+    Returns (kept, tokens used, number skipped)."""
+    kept, used, skipped = [], 0, 0
+    for chunk in chunks:
+        cost = count_tokens(chunk, model) + overhead
+        if used + cost > budget:
+            skipped += 1
+            continue
+        kept.append(chunk)
+        used += cost
+    return kept, used, skipped
+
+def pack_history(messages: Sequence[Dict], budget: int, model: str) -> Tuple[List[Dict], int]:
+    """The most recent whole messages that fit in ``budget``, oldest first"""
+    kept, used = [], 0
+    for message in reversed(messages):
+        cost = message_tokens(message.get("content") or "", model)
+        if used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept, used
@@ -0,0 +1,216 @@
+"""
+Synthetic hospital.db generator
+Builds the patient schema used by recept.py at any scale for testing and benchmarks
+
+    python generate_db.py hospital.db --patients 1000000
+"""
+
+import argparse
+import random
+import sqlite3
+import time
+from datetime import date, timedelta
+
+# ============================================================================
+# SCHEMA
+# ============================================================================
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS dietary_restrictions (
+    diet_id INTEGER PRIMARY KEY,
+    restriction_text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS warning_signs (
+    warning_id INTEGER PRIMARY KEY,
+    warning_text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS medications (
+    med_id INTEGER PRIMARY KEY,
+    medication_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id INTEGER PRIMARY KEY,
+    patient_name TEXT NOT NULL,
+    primary_diagnosis TEXT,
+    discharge_date TEXT,
+    diet_id INTEGER REFERENCES dietary_restrictions(diet_id),
+    warning_id INTEGER REFERENCES warning_signs(warning_id)
+);
+CREATE TABLE IF NOT EXISTS patient_medications (
+    patient_id INTEGER NOT NULL REFERENCES patients(patient_id),
+    med_id INTEGER NOT NULL REFERENCES medications(med_id)
+);
+"""
+
+# ============================================================================
+# SAMPLE VOCABULARY
+# ============================================================================
+
+FIRST_NAMES = [
+    "Sarah", "John", "Maria", "José", "Wei", "Aisha", "David", "Emma", "Olivia",
+    "Liam", "Noah", "Sofia", "Mateo", "Zoë", "Chloé", "Hiroshi", "Priya", "Arjun",
+    "Fatima", "Omar", "Grace", "Henry", "Isabella", "Jack", "Kavya", "Lucas",
+    "Mia", "Nathan", "Ana", "Pedro", "Rosa", "Samuel", "Thomas", "Uma",
+    "Victor", "William", "Yusuf", "Zara", "Björn", "Siobhan"
+]
+
+LAST_NAMES = [
+    "Jones", "Smith", "Garcia", "Müller", "Nguyen", "Patel", "Kim", "Johnson",
+    "Brown", "Williams", "Martínez", "Rodriguez", "Lee", "Chen", "Singh",
+    "Khan", "O'Brien", "Kowalski", "Rossi", "Novak", "Andersson", "Dubois",
+    "Yamamoto", "Okafor", "Hernández", "Schmidt", "Ivanova", "Silva", "Costa",
+    "Murphy", "Negi", "Sharma", "Haddad", "Cohen", "Lindqvist", "Fernández"
+]
+
+# Syllables for synthetic surnames, so name cardinality grows with the table
+# instead of every "Sarah Jones" matching thousands of rows
+SURNAME_SYLLABLES = [
+    "ka", "ro", "mi", "lan", "der", "son", "ber", "to", "na", "vic",
+    "ha", "li", "mor", "es", "quin", "sa", "tel", "go", "ri", "dal"
+]
+
+DIAGNOSES = [
+    "Chronic Kidney Disease Stage 3", "Chronic Kidney Disease Stage 4",
+    "Acute Kidney Injury", "Diabetic Nephropathy", "Glomerulonephritis",
+    "Nephrotic Syndrome", "Polycystic Kidney Disease", "Kidney Stones",
+    "Hypertensive Nephrosclerosis", "Congestive Heart Failure",
+    "End-Stage Renal Disease", "IgA Nephropathy"
+]
+
+MEDICATIONS = [
+    "Lisinopril 10mg daily", "Losartan 50mg daily", "Amlodipine 5mg daily",
+    "Furosemide 40mg twice daily", "Insulin glargine 10 units at bedtime",
+    "Metformin 500mg twice daily", "Sevelamer 800mg with meals",
+    "Calcitriol 0.25mcg daily", "Epoetin alfa weekly", "Atorvastatin 20mg daily",
+    "Sodium bicarbonate 650mg twice daily", "Empagliflozin 10mg daily",
+    "Carvedilol 6.25mg twice daily", "Hydralazine 25mg three times daily",
+    "Tacrolimus 2mg twice daily", "Prednisone 20mg daily",
+    "Albuterol inhaler as needed", "Ferrous sulfate 325mg daily",
+    "Allopurinol 100mg daily", "Spironolactone 25mg daily"
+]
+
+DIETS = [
+    "Renal diet: limit potassium, phosphorus and sodium",
+    "Low sodium (under 2g per day)",
+    "Fluid restriction 1.5L per day",
+    "Low protein (0.8g/kg per day)",
+    "Diabetic renal diet",
+    "Heart healthy low sodium diet"
+]
+
+WARNINGS = [
+    "Swelling in legs or ankles, shortness of breath",
+    "Decreased urine output or dark urine",
+    "Chest pain or irregular heartbeat",
+    "Confusion, severe fatigue or nausea",
+    "Fever above 38°C or pain at the fistula site",
+    "Sudden weight gain over 2kg in 2 days"
+]
+
+# ============================================================================
+# GENERATION
+# ============================================================================
+
+def _surname(rng: random.Random) -> str:
+    """Half common surnames, half generated ones (8000 combinations)"""
+    if rng.random() < 0.5:
+        return rng.choice(LAST_NAMES)
+    return "".join(rng.choice(SURNAME_SYLLABLES) for _ in range(3)).capitalize()
+
+def _patient_rows(count: int, start_id: int, rng: random.Random):
+    first_day = date(2015, 1, 1)
+    span = (date(2025, 10, 31) - first_day).days
+    for patient_id in range(start_id, start_id + count):
+        yield (
+            patient_id,
+            f"{rng.choice(FIRST_NAMES)} {_surname(rng)}",
+            rng.choice(DIAGNOSES),
+            (first_day + timedelta(days=rng.randrange(span))).isoformat(),
+            rng.randint(1, len(DIETS)),
+            rng.randint(1, len(WARNINGS))
+        )
+
+def _medication_rows(patient_ids, rng: random.Random, max_meds: int):
+    med_ids = range(1, len(MEDICATIONS) + 1)
+    for patient_id in patient_ids:
+        for med_id in rng.sample(med_ids, rng.randint(0, max_meds)):
+            yield (patient_id, med_id)
+
+def generate(path: str, patients: int, batch_size: int = 50000, max_meds: int = 5,
+             seed: int = 42, build_indexes: bool = True):
+    """Create (or extend) ``path`` with ``patients`` synthetic discharge records"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    # Bulk-load settings; the file is switched to WAL by init_db afterwards
+    conn.execute("PRAGMA journal_mode=MEMORY")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.executescript(SCHEMA_SQL)
+
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO dietary_restrictions VALUES (?, ?)", enumerate(DIETS, 1))
+        conn.executemany("INSERT OR IGNORE INTO warning_signs VALUES (?, ?)", enumerate(WARNINGS, 1))
+        conn.executemany("INSERT OR IGNORE INTO medications VALUES (?, ?)", enumerate(MEDICATIONS, 1))
+
+    start_id = (conn.execute("SELECT MAX(patient_id) FROM patients").fetchone()[0] or 0) + 1
+    started = time.perf_counter()
+    written = 0
+    while written < patients:
+        count = min(batch_size, patients - written)
+        first_id = start_id + written
+        with conn:
+            conn.executemany(
+                "INSERT INTO patients VALUES (?, ?, ?, ?, ?, ?)",
+                _patient_rows(count, first_id, rng)
+            )
+            conn.executemany(
+                "INSERT INTO patient_medications VALUES (?, ?)",
+                _medication_rows(range(first_id, first_id + count), rng, max_meds)
+            )
+        written += count
+        rate = written / (time.perf_counter() - started)
+        print(f"\r👥 {written:,}/{patients:,} patients ({rate:,.0f} rows/s)", end="", flush=True)
+    print()
+
+    # The well-known demo patient, so README examples keep working
+    if start_id == 1:
+        with conn:
+            conn.execute(
+                "UPDATE patients SET patient_name = 'Sarah Jones', primary_diagnosis = 'Congestive Heart Failure' "
+                "WHERE patient_id = 1"
+            )
+    conn.close()
+
+    if build_indexes:
+        from recept import init_db
+        print("🔎 Building lookup indexes...")
+        index_started = time.perf_counter()
+        init_db(path)
+        print(f"✅ Indexes built in {time.perf_counter() - index_started:.1f}s")
+
+    print(f"✅ {path}: {written:,} patients in {time.perf_counter() - started:.1f}s")
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic hospital.db")
+    parser.add_argument("path", help="SQLite file to create or extend")
+    parser.add_argument("--patients", type=int, default=10000, help="Number of patients to add (10k to 10M)")
+    parser.add_argument("--batch-size", type=int, default=50000, help="Rows per transaction")
+    parser.add_argument("--max-meds", type=int, default=5, help="Maximum medications per patient")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-indexes", action="store_true", help="Skip recept.init_db (search indexes, WAL)")
+    args = parser.parse_args()
+
+    generate(
+        args.path,
+        args.patients,
+        batch_size=args.batch_size,
+        max_meds=args.max_meds,
+        seed=args.seed,
+        build_indexes=not args.no_indexes
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Bulk discharge-record ingestion for hospital.db
+Streams CSV or NDJSON discharge feeds into the patient tables in sized WAL
+transactions, so GetPatient keeps reading while a feed loads
+
+    python ingest.py discharges.csv --db hospital.db
+    cat feed.ndjson | python ingest.py - --format ndjson --db hospital.db
+
+Each record needs a name; everything else is optional:
+    patient_id, name, diagnosis, discharge_date, medications, diet, warnings
+(the table column names patient_name, primary_diagnosis, restriction_text and
+warning_text work too). In CSV, medications are separated by ";". Records with
+an existing patient_id replace that patient's discharge record.
+"""
+
+import argparse
+import csv
+import io
+import json
+import sqlite3
+import sys
+import time
+
+from generate_db import SCHEMA_SQL
+from recept import init_db, name_keys
+
+# ============================================================================
+# INPUT
+# ============================================================================
+
+FIELD_ALIASES = {
+    "patient_name": "name",
+    "primary_diagnosis": "diagnosis",
+    "restriction_text": "diet",
+    "warning_text": "warnings",
+    "medication_names": "medications",
+}
+
+TEXT_FIELDS = ("name", "diagnosis", "discharge_date", "diet", "warnings")
+
+def _normalize(raw: dict) -> dict:
+    """Canonical record from one CSV row or JSON object.
+
+    Raises ValueError for a field of the wrong type, so one bad record is
+    reported and skipped instead of aborting the load.
+    """
+    record = {}
+    for key, value in raw.items():
+        if key is None:
+            continue
+        key = key.strip().lower()
+        record[FIELD_ALIASES.get(key, key)] = value.strip() if isinstance(value, str) else value
+    for key in TEXT_FIELDS:
+        if not isinstance(record.get(key), (str, type(None))):
+            raise ValueError(f"{key} must be a string")
+    meds = record.get("medications") or []
+    if isinstance(meds, str):
+        meds = meds.split(";")
+    if not isinstance(meds, list) or not all(isinstance(m, (str, type(None))) for m in meds):
+        raise ValueError("medications must be a list of strings")
+    record["medications"] = [m.strip() for m in meds if m and m.strip()]
+    record["patient_id"] = _patient_id(record.get("patient_id"))
+    for key in ("diagnosis", "discharge_date", "diet", "warnings"):
+        record[key] = record.get(key) or None
+    return record
+
+def _patient_id(value):
+    if value is None or value == "":
+        return None
+    # JSON true/false would pass as int
+    if isinstance(value, bool) or not (isinstance(value, int) or isinstance(value, str) and value.isdecimal()):
+        raise ValueError(f"patient_id must be a whole number, not {value!r}")
+    patient_id = int(value)
+    if patient_id >= 2 ** 63:
+        raise ValueError(f"patient_id {patient_id} does not fit in SQLite")
+    return patient_id
+
+def read_records(stream, fmt: str):
+    """Yield (line number, record) pairs; malformed lines yield (line, error)"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            try:
+                yield reader.line_num, _normalize(row)
+            except ValueError as e:
+                yield reader.line_num, e
+        return
+    for line_num, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            raw = json.loads(line)
+            if not isinstance(raw, dict):
+                raise ValueError("expected a JSON object")
+            yield line_num, _normalize(raw)
+        except ValueError as e:
+            yield line_num, e
+
+def detect_format(path: str) -> str:
+    return "ndjson" if path.endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+# ============================================================================
+# LOOKUP MAPS
+# ============================================================================
+
+class LookupMap:
+    """Text → id for one lookup table, loaded once and extended in place"""
+
+    def __init__(self, conn: sqlite3.Connection, table: str, key: str, column: str):
+        self.table = table
+        self.key = key
+        self.column = column
+        self.ids = {text: id_ for id_, text in conn.execute(f"SELECT {key}, {column} FROM {table}")}
+        self.next_id = max(self.ids.values(), default=0) + 1
+        self.pending = []
+
+    def resolve(self, text: str):
+        if not text:
+            return None
+        id_ = self.ids.get(text)
+        if id_ is None:
+            id_ = self.ids[text] = self.next_id
+            self.next_id += 1
+            self.pending.append((id_, text))
+        return id_
+
+    def flush(self, conn: sqlite3.Connection):
+        """Write values first seen in this batch (inside the batch transaction)"""
+        if self.pending:
+            conn.executemany(f"INSERT INTO {self.table}({self.key}, {self.column}) VALUES (?, ?)", self.pending)
+            self.pending = []
+
+# ============================================================================
+# INGESTION
+# ============================================================================
+
+class Ingester:
+    def __init__(self, path: str, batch_size: int = 5000, cache_kib: int = 256 * 1024):
+        self.path = path
+        self.batch_size = batch_size
+        conn = sqlite3.connect(path)
+        conn.executescript(SCHEMA_SQL)
+        conn.close()
+        # WAL, search indexes and their triggers, so every insert below keeps them current
+        init_db(path)
+
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=10000")
+        # Room for the hot index pages (postings, name keys, summaries) of a large load
+        self.conn.execute(f"PRAGMA cache_size=-{cache_kib}")
+        self.medications = LookupMap(self.conn, "medications", "med_id", "medication_name")
+        self.diets = LookupMap(self.conn, "dietary_restrictions", "diet_id", "restriction_text")
+        self.warnings = LookupMap(self.conn, "warning_signs", "warning_id", "warning_text")
+        self.next_patient_id = (self.conn.execute("SELECT MAX(patient_id) FROM patients").fetchone()[0] or 0) + 1
+        self.has_name_keys = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'patient_name_keys'"
+        ).fetchone() is not None
+        self.has_key_queue = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'patient_name_keys_pending'"
+        ).fetchone() is not None
+
+    def write_batch(self, records: list) -> int:
+        """Upsert one batch in a single transaction; returns the patients written"""
+        by_id = {}
+        for record in records:
+            patient_id = record["patient_id"]
+            if patient_id is None:
+                patient_id = self.next_patient_id
+            self.next_patient_id = max(self.next_patient_id, patient_id + 1)
+            # A patient repeated within the batch: the last record wins
+            by_id.pop(patient_id, None)
+            by_id[patient_id] = record
+
+        patients, meds, keys = [], [], []
+        for patient_id, record in by_id.items():
+            patients.append((
+                patient_id,
+                record["name"],
+                record["diagnosis"],
+                record["discharge_date"],
+                self.diets.resolve(record["diet"]),
+                self.warnings.resolve(record["warnings"])
+            ))
+            meds.extend((patient_id, self.medications.resolve(m)) for m in dict.fromkeys(record["medications"]))
+            keys.extend((key, patient_id) for key in name_keys(record["name"]))
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for lookup in (self.medications, self.diets, self.warnings):
+                lookup.flush(self.conn)
+            ids = [(p[0],) for p in patients]
+            # Replaced patients get exactly the medication list from the feed
+            self.conn.executemany("DELETE FROM patient_medications WHERE patient_id = ?", ids)
+            # Medications before patients: the summary trigger on patients then
+            # builds each document once, with the full medication list
+            self.conn.executemany("INSERT INTO patient_medications(patient_id, med_id) VALUES (?, ?)", meds)
+            # Existing patients are UPDATEd (not REPLACEd) so the update triggers keep
+            # the indexes in sync. Not an upsert either: ON CONFLICT DO UPDATE turns the
+            # INSERT OR IGNOREs inside those triggers into hard constraint errors.
+            existing = {row[0] for row in self.conn.execute(
+                "SELECT patient_id FROM patients WHERE patient_id IN (SELECT value FROM json_each(?))",
+                (json.dumps([p[0] for p in patients]),)
+            )}
+            self.conn.executemany("""
+                INSERT INTO patients(patient_id, patient_name, primary_diagnosis, discharge_date, diet_id, warning_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [p for p in patients if p[0] not in existing])
+            self.conn.executemany("""
+                UPDATE patients SET patient_name = ?, primary_diagnosis = ?, discharge_date = ?,
+                                    diet_id = ?, warning_id = ?
+                WHERE patient_id = ?
+            """, [(*p[1:], p[0]) for p in patients if p[0] in existing])
+            if self.has_name_keys:
+                self.conn.executemany("INSERT OR IGNORE INTO patient_name_keys(name_key, patient_id) VALUES (?, ?)", keys)
+            if self.has_key_queue:
+                # Keys are already written above; the server need not recompute them
+                self.conn.executemany("DELETE FROM patient_name_keys_pending WHERE patient_id = ?", ids)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return len(patients)
+
+    def run(self, records) -> dict:
+        started = time.perf_counter()
+        written = skipped = 0
+        errors = []
+        batch = []
+        for line_num, record in records:
+            if isinstance(record, Exception) or not record.get("name"):
+                skipped += 1
+                if len(errors) < 10:
+                    errors.append(f"line {line_num}: {record if isinstance(record, Exception) else 'missing name'}")
+                continue
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                written += self.write_batch(batch)
+                batch = []
+                rate = written / (time.perf_counter() - started)
+                print(f"\r📥 {written:,} records ({rate:,.0f} rows/s)", end="", file=sys.stderr, flush=True)
+        if batch:
+            written += self.write_batch(batch)
+        elapsed = time.perf_counter() - started
+        print(file=sys.stderr)
+        return {
+            "written": written,
+            "skipped": skipped,
+            "seconds": round(elapsed, 2),
+            "rows_per_s": round(written / elapsed, 1) if elapsed else 0.0,
+            "errors": errors
+        }
+
+    def close(self):
+        self.conn.close()
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Load discharge records into hospital.db")
+    parser.add_argument("input", help="CSV or NDJSON file, or - for stdin")
+    parser.add_argument("--db", required=True, help="SQLite database to load into")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="Input format (default: from the file extension)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Records per transaction")
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.input == "-" else detect_format(args.input))
+    if args.input == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    else:
+        stream = open(args.input, encoding="utf-8", newline="")
+
+    ingester = Ingester(args.db, batch_size=args.batch_size)
+    try:
+        with stream:
+            report = ingester.run(read_records(stream, fmt))
+    finally:
+        ingester.close()
+
+    print(f"✅ {report['written']:,} records in {report['seconds']}s ({report['rows_per_s']:,.0f} rows/s), "
+          f"{report['skipped']} skipped")
+    for error in report["errors"]:
+        print(f"  ⚠️  {error}")
+
+if __name__ == "__main__":
+    main()
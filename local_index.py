@@ -0,0 +1,390 @@
+"""
+Local textbook vector index for the nephrology chatbot
+Chunk embeddings in a memory-mapped float32 matrix, searched with NumPy top-k,
+with an optional IVF (inverted file) layout for larger corpora, and a BM25
+inverted index for hybrid (keyword + vector) retrieval. Returns the same
+documents (id, content, page, chapter) as the Azure AI Search index
+
+    python local_index.py export --output textbook_index            # copy the Azure index
+    python local_index.py build chunks.jsonl --output textbook_index --ivf 256
+    python local_index.py search textbook_index "potassium binders" --k 8 --hybrid
+
+Index directory layout:
+    meta.json      dim, count, embedding model and IVF offsets (if any)
+    vectors.f32    count x dim float32 rows, L2-normalized, in list order
+    chunks.jsonl   one {"id", "content", "page", "chapter"} per row, same order
+    centroids.f32  nlist x dim float32 (IVF only)
+    bm25.json      vocabulary (term → postings number) and average chunk length
+    bm25_offsets.i64, bm25_docs.i32, bm25_tf.f32, bm25_len.f32
+                   postings in CSR form: rows and term counts per term, chunk lengths
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+CHUNK_FIELDS = ("id", "content", "page", "chapter")
+
+# Reciprocal-rank fusion constant (the value Azure AI Search uses too)
+RRF_K = 60
+
+# ============================================================================
+# KEYWORD INDEX (BM25)
+# ============================================================================
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from has have how i if in is it its me my
+of on or should so that the their there this to was what when where which who why
+will with you your
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+BM25_FILES = ("bm25_offsets.i64", "bm25_docs.i32", "bm25_tf.f32", "bm25_len.f32")
+
+class BM25:
+    """Okapi BM25 over an inverted index held as CSR arrays.
+
+    Query cost is proportional to the postings of the query terms, not to
+    the corpus, so it adds little to a vector query.
+    """
+
+    def __init__(self, terms: Dict[str, int], offsets, docs, tfs, doc_len, k1: float = 1.2, b: float = 0.75):
+        self.terms = terms
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.avg_len = float(doc_len.mean()) if len(doc_len) else 0.0
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def from_texts(cls, texts: Sequence[str]) -> "BM25":
+        postings = {}
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text or "")
+            doc_len[row] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((row, tf))
+        terms, offsets, docs, tfs = {}, [0], [], []
+        for i, (term, entries) in enumerate(sorted(postings.items())):
+            terms[term] = i
+            docs.extend(row for row, _ in entries)
+            tfs.extend(tf for _, tf in entries)
+            offsets.append(len(docs))
+        return cls(terms, np.asarray(offsets, dtype=np.int64), np.asarray(docs, dtype=np.int32),
+                   np.asarray(tfs, dtype=np.float32), doc_len)
+
+    def save(self, path: str):
+        for name, array in zip(BM25_FILES, (self.offsets, self.docs, self.tfs, self.doc_len)):
+            array.tofile(os.path.join(path, name))
+        with open(os.path.join(path, "bm25.json"), "w", encoding="utf-8") as f:
+            json.dump({"terms": self.terms, "avg_len": self.avg_len}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25":
+        with open(os.path.join(path, "bm25.json"), encoding="utf-8") as f:
+            terms = json.load(f)["terms"]
+        dtypes = (np.int64, np.int32, np.float32, np.float32)
+        arrays = [np.fromfile(os.path.join(path, name), dtype=dtype) for name, dtype in zip(BM25_FILES, dtypes)]
+        return cls(terms, *arrays)
+
+    def top(self, text: str, n: int):
+        """(rows, scores) of the ``n`` best chunks for ``text``, best first"""
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        count = len(self.doc_len)
+        for term in set(tokenize(text)):
+            i = self.terms.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            docs, tf = self.docs[start:end], self.tfs[start:end]
+            idf = math.log(1 + (count - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / (self.avg_len or 1.0))
+            # Rows are unique within one term's postings, so plain fancy-index += is safe
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm)
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return matched, scores[matched]
+        if len(matched) > n:
+            matched = matched[np.argpartition(-scores[matched], n - 1)[:n]]
+        matched = matched[np.argsort(-scores[matched])]
+        return matched, scores[matched]
+
+# ============================================================================
+# FUSION AND RERANKING
+# ============================================================================
+
+def rrf_fuse(rankings: Sequence[Sequence], k: int = RRF_K) -> Dict:
+    """Reciprocal-rank fusion: key → sum of 1 / (k + rank) over the rankings it is in"""
+    fused = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return fused
+
+def rerank(candidates: List[Dict], text: str, k: int, term_weight: float = 0.3) -> List[Dict]:
+    """Order fused candidates by their (normalized) fusion score plus the share
+    of the query's terms they contain, so chunks naming the exact drug or lab
+    test asked about move up. Each candidate needs "content" and "fused"."""
+    query_terms = set(tokenize(text))
+    top_fused = max((c["fused"] for c in candidates), default=0.0) or 1.0
+    for candidate in candidates:
+        coverage = 0.0
+        if query_terms:
+            coverage = len(query_terms.intersection(tokenize(candidate.get("content") or ""))) / len(query_terms)
+        candidate["score"] = candidate["fused"] / top_fused + term_weight * coverage
+    return sorted(candidates, key=lambda c: c["score"], reverse=True)[:k]
+
+# ============================================================================
+# SEARCH
+# ============================================================================
+
+class LocalIndex:
+    """Read-only vector index over a directory written by ``build_index``.
+
+    Vectors are memory-mapped, so opening is instant and the OS page cache
+    holds them across processes. Scores are cosine similarities.
+    """
+
+    def __init__(self, path: str, nprobe: int = 8):
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("numpy is required for the local index → pip install numpy")
+        self.path = path
+        self.nprobe = nprobe
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        self.count = self.meta["count"]
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                                 shape=(self.count, self.dim))
+        with open(os.path.join(path, "chunks.jsonl"), encoding="utf-8") as f:
+            self.chunks = [json.loads(line) for line in f]
+        self._bm25 = None
+        self.offsets = None
+        self.centroids = None
+        if self.meta.get("ivf_offsets"):
+            self.offsets = np.asarray(self.meta["ivf_offsets"], dtype=np.int64)
+            self.centroids = np.fromfile(os.path.join(path, "centroids.f32"), dtype=np.float32).reshape(-1, self.dim)
+            # Probing zero lists would search nothing; more than exist is a full scan
+            self.nprobe = max(1, min(int(nprobe), len(self.centroids)))
+
+    def _candidate_rows(self, query):
+        """Rows of the ``nprobe`` closest IVF lists, or None to scan everything"""
+        if self.centroids is None or self.nprobe >= len(self.centroids):
+            return None
+        closest = np.argpartition(-(self.centroids @ query), self.nprobe - 1)[:self.nprobe]
+        # Each list is a contiguous block of rows, so this reads whole slices
+        return np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in np.sort(closest)])
+
+    @property
+    def bm25(self) -> BM25:
+        """Keyword index, loaded on first use (built in memory for indexes that predate it)"""
+        if self._bm25 is None:
+            if os.path.exists(os.path.join(self.path, "bm25.json")):
+                self._bm25 = BM25.load(self.path)
+            else:
+                self._bm25 = BM25.from_texts([chunk.get("content") for chunk in self.chunks])
+        return self._bm25
+
+    def _vector_top(self, vector: List[float], k: int):
+        """(rows, cosine scores) of the ``k`` nearest chunks, best first"""
+        query = np.asarray(vector, dtype=np.float32)
+        if query.shape != (self.dim,):
+            raise ValueError(f"query has {query.size} dimensions, index has {self.dim}")
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        rows = self._candidate_rows(query)
+        scores = (self.vectors if rows is None else self.vectors[rows]) @ query
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), scores[:0]
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return (top if rows is None else rows[top]), scores[top]
+
+    def search(self, vector: List[float], k: int = 8) -> List[Dict]:
+        """Top ``k`` chunks by cosine similarity, best first, each with a ``score``"""
+        rows, scores = self._vector_top(vector, k)
+        return [dict(self.chunks[int(row)], score=float(score)) for row, score in zip(rows, scores)]
+
+    def hybrid_search(self, vector: List[float], text: str, k: int = 8, candidates: int = None,
+                      term_weight: float = 0.3) -> List[Dict]:
+        """BM25 and vector rankings fused by reciprocal rank, then reranked locally.
+
+        One vector scan (the same as ``search``) plus a postings lookup; the
+        fusion and rerank only touch the ``candidates`` best of each list.
+        """
+        candidates = candidates or 4 * k
+        vector_rows, _ = self._vector_top(vector, candidates)
+        keyword_rows, _ = self.bm25.top(text, candidates)
+        fused = rrf_fuse([vector_rows.tolist(), keyword_rows.tolist()])
+        best = sorted(fused, key=fused.get, reverse=True)[:2 * k]
+        return rerank([dict(self.chunks[row], fused=fused[row]) for row in best], text, k, term_weight)
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "chunks": self.count,
+            "dim": self.dim,
+            "model": self.meta.get("model"),
+            "ivf_lists": len(self.centroids) if self.centroids is not None else 0,
+            "bm25_terms": len(self._bm25.terms) if self._bm25 is not None else None,
+            "nprobe": self.nprobe if self.centroids is not None else None
+        }
+
+# ============================================================================
+# BUILD
+# ============================================================================
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _kmeans(vectors, nlist: int, iterations: int = 10, sample: int = 50000, seed: int = 0):
+    """Spherical k-means centroids, fitted on a sample of (normalized) rows"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+def _assign(vectors, centroids, batch: int = 8192):
+    return np.concatenate([
+        np.argmax(vectors[start:start + batch] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), batch)
+    ])
+
+def build_index(records: Iterable[Dict], output: str, ivf_lists: int = 0, model: str = None) -> dict:
+    """Write an index directory from records with a ``vector`` and the chunk fields"""
+    chunks, vectors = [], []
+    for idx, record in enumerate(records):
+        vector = record.get("vector") or record.get("contentVector")
+        if not vector or not record.get("content"):
+            continue
+        chunk = {field: record.get(field) for field in CHUNK_FIELDS}
+        chunk["id"] = chunk["id"] or f"chunk_{idx}"
+        chunks.append(chunk)
+        vectors.append(vector)
+    if not chunks:
+        raise ValueError("no records with both content and a vector")
+
+    matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+    meta = {"dim": int(matrix.shape[1]), "count": len(chunks), "model": model}
+
+    os.makedirs(output, exist_ok=True)
+    # Written last (below): a directory without meta.json is not an index yet
+    if os.path.exists(os.path.join(output, "meta.json")):
+        os.remove(os.path.join(output, "meta.json"))
+    if ivf_lists and ivf_lists < len(chunks):
+        centroids = _kmeans(matrix, ivf_lists)
+        assignment = _assign(matrix, centroids)
+        # Rows grouped by list so a probe reads contiguous slices
+        order = np.argsort(assignment, kind="stable")
+        matrix = matrix[order]
+        chunks = [chunks[i] for i in order]
+        meta["ivf_offsets"] = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=ivf_lists))]).tolist()
+        centroids.astype(np.float32).tofile(os.path.join(output, "centroids.f32"))
+    elif os.path.exists(os.path.join(output, "centroids.f32")):
+        os.remove(os.path.join(output, "centroids.f32"))
+
+    matrix.astype(np.float32).tofile(os.path.join(output, "vectors.f32"))
+    with open(os.path.join(output, "chunks.jsonl"), "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+    bm25 = BM25.from_texts([chunk["content"] for chunk in chunks])
+    bm25.save(output)
+    meta["bm25_terms"] = len(bm25.terms)
+    with open(os.path.join(output, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+def read_jsonl(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def export_azure():
+    """Every document of the configured Azure AI Search index, with its vector"""
+    from research import get_clients
+    search_client = get_clients().search
+    results = search_client.search(
+        search_text="*",
+        select=list(CHUNK_FIELDS) + ["contentVector"],
+        top=None
+    )
+    yield from results
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Local textbook vector index")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="Build from JSONL chunks with vectors")
+    build.add_argument("input", help="JSONL with content, page, chapter and vector per line")
+    build.add_argument("--output", default="textbook_index")
+    build.add_argument("--ivf", type=int, default=0, help="IVF lists (0 = exact search)")
+    build.add_argument("--model", help="Embedding model the vectors came from")
+
+    export = sub.add_parser("export", help="Build from the Azure AI Search index in research.py's config")
+    export.add_argument("--output", default="textbook_index")
+    export.add_argument("--ivf", type=int, default=0, help="IVF lists (0 = exact search)")
+
+    search = sub.add_parser("search", help="Query an index (embeds the text via research.py)")
+    search.add_argument("index")
+    search.add_argument("query")
+    search.add_argument("--k", type=int, default=8)
+    search.add_argument("--nprobe", type=int, default=8)
+    search.add_argument("--hybrid", action="store_true", help="BM25 + vector fusion with local rerank")
+    args = parser.parse_args()
+
+    if args.command == "search":
+        from research import generate_embeddings, get_clients
+        index = LocalIndex(args.index, nprobe=args.nprobe)
+        vector = generate_embeddings(args.query, get_clients().openai)
+        started = time.perf_counter()
+        results = index.hybrid_search(vector, args.query, args.k) if args.hybrid else index.search(vector, args.k)
+        print(f"🔎 {len(results)} results in {(time.perf_counter() - started) * 1000:.2f}ms")
+        for result in results:
+            print(f"  {result['score']:.3f}  p.{result.get('page')}  {result['content'][:100]!r}")
+        return
+
+    started = time.perf_counter()
+    if args.command == "export":
+        from research import Config
+        meta = build_index(export_azure(), args.output, args.ivf, Config.EMBEDDING_MODEL)
+    else:
+        meta = build_index(read_jsonl(args.input), args.output, args.ivf, args.model)
+    print(f"✅ {args.output}: {meta['count']:,} chunks x {meta['dim']} dims"
+          f"{', %d IVF lists' % (len(meta['ivf_offsets']) - 1) if meta.get('ivf_offsets') else ''}"
+          f" in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,1558 @@
 
+import argparse
+import asyncio
+import logging
+import os
+import queue
 import sqlite3
 import json
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from acp_sdk.models import MessagePart
 from acp_sdk.server import Server
 
+from codec import NDJSON_CONTENT_TYPE, Payload, decode_input, dumps_json, encode_part, loads_json, negotiate
+
 server = Server()
+logger = logging.getLogger("recept")
 DB_PATH = "/Users/kavyanegi/Downloads/acp-2 /hospital.db"
 
-def get_patient_full(name_query: str):
-    if not name_query or not name_query.strip():
-        return {"error": "No name provided"}
-    
-    pattern = '%' + '%'.join(name_query.strip().split()) + '%'
-    
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT p.*, d.restriction_text as diet, w.warning_text as warnings
-        FROM patients p
-        LEFT JOIN dietary_restrictions d ON p.diet_id = d.diet_id
-        LEFT JOIN warning_signs w ON p.warning_id = w.warning_id
-        WHERE p.patient_name LIKE ?
-        ORDER BY discharge_date DESC LIMIT 1
-    """, (pattern,))
-    row = cur.fetchone()
-    
-    if not row:
+# Optional shard layout: "north=/data/north.db,south=/data/south.db" (one file
+# per facility) or plain "a.db,b.db". Empty means DB_PATH is the only shard.
+DB_SHARDS = os.getenv("PATIENT_DB_SHARDS", "")
+# "facility": a patient_id may exist in any shard, ID lookups ask all of them.
+# "hash": patient_id % shard count names the one shard holding that patient.
+DB_SHARD_BY = os.getenv("PATIENT_DB_SHARD_BY", "facility")
+
+# Connection pool tuning (read-only connections, shared by all agent threads)
+DB_POOL_SIZE = int(os.getenv("PATIENT_DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("PATIENT_DB_POOL_TIMEOUT", "5"))
+DB_MMAP_SIZE = int(os.getenv("PATIENT_DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_KIB = int(os.getenv("PATIENT_DB_CACHE_KIB", str(64 * 1024)))
+
+def _name_tokens_sql(expr: str) -> str:
+    """Table-valued SQL splitting the name ``expr`` into lower-case words.
+
+    SQLite has no split(), so the name is turned into a JSON array on spaces
+    (tabs/newlines count as spaces) and read back with json_each. Names that
+    still are not valid JSON (other control characters) yield no words.
+    """
+    escaped = (
+        f"replace(replace(replace(replace(replace(lower(trim({expr})), "
+        f"'\\', '\\\\'), '\"', '\\\"'), char(9), ' '), char(10), ' '), char(13), ' ')"
+    )
+    array = f"""'["' || replace({escaped}, ' ', '","') || '"]'"""
+    return f"json_each(CASE WHEN json_valid({array}) THEN {array} ELSE '[]' END)"
+
+def _name_words_sql(expr: str) -> str:
+    return f"SELECT DISTINCT value FROM {_name_tokens_sql(expr)} WHERE value <> ''"
+
+# Word index over patients.patient_name. Postings are keyed by
+# (word, discharge_date), so a lookup walks the rarest query word's patients
+# newest first and stops at the first full "%tok%tok%" LIKE match -- the same
+# answer as before without scanning patients. A trigram FTS5 table over the
+# (small) word vocabulary maps each query token to the words containing it.
+# Triggers keep everything in sync with every write.
+NAME_INDEX_SQL = f"""
+CREATE TABLE IF NOT EXISTS name_tokens (
+    token_id INTEGER PRIMARY KEY,
+    token TEXT NOT NULL UNIQUE,
+    patients INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS patient_name_tokens (
+    token_id INTEGER NOT NULL,
+    discharge_date TEXT NOT NULL,
+    patient_id INTEGER NOT NULL,
+    PRIMARY KEY (token_id, discharge_date, patient_id)
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS name_token_fts USING fts5(
+    token, content='name_tokens', content_rowid='token_id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS name_tokens_ai AFTER INSERT ON name_tokens BEGIN
+    INSERT INTO name_token_fts(rowid, token) VALUES (new.token_id, new.token);
+END;
+CREATE TRIGGER IF NOT EXISTS patients_tokens_ai AFTER INSERT ON patients BEGIN
+    INSERT OR IGNORE INTO name_tokens(token) {_name_words_sql('new.patient_name')};
+    UPDATE name_tokens SET patients = patients + 1
+    WHERE token IN ({_name_words_sql('new.patient_name')});
+    INSERT OR IGNORE INTO patient_name_tokens(token_id, discharge_date, patient_id)
+    SELECT token_id, COALESCE(new.discharge_date, ''), new.patient_id FROM name_tokens
+    WHERE token IN ({_name_words_sql('new.patient_name')});
+END;
+CREATE TRIGGER IF NOT EXISTS patients_tokens_ad AFTER DELETE ON patients BEGIN
+    DELETE FROM patient_name_tokens
+    WHERE patient_id = old.patient_id AND discharge_date = COALESCE(old.discharge_date, '')
+      AND token_id IN (SELECT token_id FROM name_tokens WHERE token IN ({_name_words_sql('old.patient_name')}));
+    UPDATE name_tokens SET patients = patients - 1
+    WHERE token IN ({_name_words_sql('old.patient_name')});
+END;
+CREATE TRIGGER IF NOT EXISTS patients_tokens_au
+AFTER UPDATE OF patient_id, patient_name, discharge_date ON patients BEGIN
+    DELETE FROM patient_name_tokens
+    WHERE patient_id = old.patient_id AND discharge_date = COALESCE(old.discharge_date, '')
+      AND token_id IN (SELECT token_id FROM name_tokens WHERE token IN ({_name_words_sql('old.patient_name')}));
+    UPDATE name_tokens SET patients = patients - 1
+    WHERE token IN ({_name_words_sql('old.patient_name')});
+    INSERT OR IGNORE INTO name_tokens(token) {_name_words_sql('new.patient_name')};
+    UPDATE name_tokens SET patients = patients + 1
+    WHERE token IN ({_name_words_sql('new.patient_name')});
+    INSERT OR IGNORE INTO patient_name_tokens(token_id, discharge_date, patient_id)
+    SELECT token_id, COALESCE(new.discharge_date, ''), new.patient_id FROM name_tokens
+    WHERE token IN ({_name_words_sql('new.patient_name')});
+END;
+"""
+
+# One-off fill of the word index for rows that predate it
+NAME_INDEX_BUILD_SQL = f"""
+INSERT OR IGNORE INTO name_tokens(token)
+SELECT DISTINCT w.value FROM patients p, {_name_tokens_sql('p.patient_name')} w
+WHERE w.value <> '';
+INSERT OR IGNORE INTO patient_name_tokens(token_id, discharge_date, patient_id)
+SELECT v.token_id, COALESCE(p.discharge_date, ''), p.patient_id
+FROM patients p, {_name_tokens_sql('p.patient_name')} w
+JOIN name_tokens v ON v.token = w.value
+ORDER BY 1, 2, 3;
+UPDATE name_tokens SET patients = (
+    SELECT COUNT(*) FROM patient_name_tokens t WHERE t.token_id = name_tokens.token_id
+);
+"""
+
+# Superseded trigram index over the full names
+LEGACY_NAME_INDEX_SQL = """
+DROP TRIGGER IF EXISTS patients_name_ai;
+DROP TRIGGER IF EXISTS patients_name_ad;
+DROP TRIGGER IF EXISTS patients_name_au;
+DROP TABLE IF EXISTS patient_name_fts;
+"""
+
+# Covering indexes for the record fetch: medications by patient, the
+# "latest discharge wins" ordering, and diagnosis cohorts in discharge order.
+LOOKUP_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_patient_medications_patient
+    ON patient_medications(patient_id, med_id);
+CREATE INDEX IF NOT EXISTS idx_patients_discharge
+    ON patients(discharge_date);
+CREATE INDEX IF NOT EXISTS idx_patients_diagnosis
+    ON patients(primary_diagnosis COLLATE NOCASE, discharge_date);
+"""
+
+# Phonetic keys for typo-tolerant lookup: one Soundex code per folded name
+# token. Soundex is Python, so triggers cannot compute it: inserts and renames
+# queue the patient in patient_name_keys_pending (in SQL, from any writer) and
+# refresh_pending_name_keys() computes the queued keys. ingest.py computes
+# keys for its own batches; the server's NameKeyRefresher thread drains what
+# other writers queue, so lookups never write. init_db also fills in keys for
+# rows that predate the table (refresh_name_keys).
+NAME_KEYS_SQL = """
+CREATE TABLE IF NOT EXISTS patient_name_keys (
+    name_key TEXT NOT NULL,
+    patient_id INTEGER NOT NULL,
+    PRIMARY KEY (name_key, patient_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_patient_name_keys_patient
+    ON patient_name_keys(patient_id);
+CREATE TABLE IF NOT EXISTS patient_name_keys_pending (
+    patient_id INTEGER PRIMARY KEY
+);
+DROP TRIGGER IF EXISTS patients_keys_ad;
+DROP TRIGGER IF EXISTS patients_keys_au;
+CREATE TRIGGER IF NOT EXISTS patients_keys_ai AFTER INSERT ON patients BEGIN
+    INSERT OR IGNORE INTO patient_name_keys_pending(patient_id) VALUES (new.patient_id);
+END;
+CREATE TRIGGER patients_keys_ad AFTER DELETE ON patients BEGIN
+    DELETE FROM patient_name_keys WHERE patient_id = old.patient_id;
+    DELETE FROM patient_name_keys_pending WHERE patient_id = old.patient_id;
+END;
+CREATE TRIGGER patients_keys_au AFTER UPDATE OF patient_id, patient_name ON patients BEGIN
+    DELETE FROM patient_name_keys WHERE patient_id = old.patient_id;
+    DELETE FROM patient_name_keys_pending WHERE patient_id = old.patient_id;
+    INSERT OR IGNORE INTO patient_name_keys_pending(patient_id) VALUES (new.patient_id);
+END;
+"""
+
+# Ready-to-serve patient documents (the exact dict get_patient_full returns),
+# so reads are a primary-key probe instead of a five-table join. Triggers
+# rewrite a patient's document whenever anything it is built from changes.
+def _summary_refresh_sql(where: str) -> str:
+    return f"""
+    INSERT OR REPLACE INTO patient_summary(patient_id, document)
+    SELECT p.patient_id, json_object(
+        'name', p.patient_name,
+        'diagnosis', p.primary_diagnosis,
+        'discharge_date', p.discharge_date,
+        'medications', json((SELECT json_group_array(m.medication_name)
+                               FROM patient_medications pm
+                               JOIN medications m ON m.med_id = pm.med_id
+                              WHERE pm.patient_id = p.patient_id)),
+        'diet', d.restriction_text,
+        'warnings', w.warning_text
+    )
+    FROM patients p
+    LEFT JOIN dietary_restrictions d ON p.diet_id = d.diet_id
+    LEFT JOIN warning_signs w ON p.warning_id = w.warning_id
+    WHERE {where};"""
+
+SUMMARY_SQL = f"""
+CREATE TABLE IF NOT EXISTS patient_summary (
+    patient_id INTEGER PRIMARY KEY,
+    document TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS patients_summary_ai AFTER INSERT ON patients BEGIN
+    {_summary_refresh_sql("p.patient_id = new.patient_id")}
+END;
+CREATE TRIGGER IF NOT EXISTS patients_summary_au AFTER UPDATE ON patients BEGIN
+    DELETE FROM patient_summary WHERE patient_id = old.patient_id;
+    {_summary_refresh_sql("p.patient_id = new.patient_id")}
+END;
+CREATE TRIGGER IF NOT EXISTS patients_summary_ad AFTER DELETE ON patients BEGIN
+    DELETE FROM patient_summary WHERE patient_id = old.patient_id;
+END;
+CREATE TRIGGER IF NOT EXISTS patient_medications_summary_ai AFTER INSERT ON patient_medications BEGIN
+    {_summary_refresh_sql("p.patient_id = new.patient_id")}
+END;
+CREATE TRIGGER IF NOT EXISTS patient_medications_summary_au AFTER UPDATE ON patient_medications BEGIN
+    {_summary_refresh_sql("p.patient_id IN (old.patient_id, new.patient_id)")}
+END;
+CREATE TRIGGER IF NOT EXISTS patient_medications_summary_ad AFTER DELETE ON patient_medications BEGIN
+    {_summary_refresh_sql("p.patient_id = old.patient_id")}
+END;
+"""
+
+def _lookup_summary_triggers() -> str:
+    """Lookup tables are rarely edited, but an edit fans out to every patient using the row"""
+    sql = ""
+    for table, key, patients_using in [
+        ("medications", "med_id",
+         "p.patient_id IN (SELECT patient_id FROM patient_medications WHERE med_id IN ({old}, {new}))"),
+        ("dietary_restrictions", "diet_id", "p.diet_id IN ({old}, {new})"),
+        ("warning_signs", "warning_id", "p.warning_id IN ({old}, {new})"),
+    ]:
+        for event, old, new in [("INSERT", "new", "new"), ("UPDATE", "old", "new"), ("DELETE", "old", "old")]:
+            where = patients_using.format(old=f"{old}.{key}", new=f"{new}.{key}")
+            sql += f"""
+CREATE TRIGGER IF NOT EXISTS {table}_summary_{event[0].lower()} AFTER {event} ON {table} BEGIN
+    {_summary_refresh_sql(where)}
+END;"""
+    return sql
+
+SUMMARY_SQL += _lookup_summary_triggers()
+
+SUMMARY_BUILD_SQL = _summary_refresh_sql("1")
+
+_SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"), **dict.fromkeys("cgjkqsxz", "2"),
+    **dict.fromkeys("dt", "3"), "l": "4", **dict.fromkeys("mn", "5"), "r": "6"
+}
+
+def fold_name(text: str) -> str:
+    """Lower-case, strip accents (José → jose) and keep only letters/spaces"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(
+        ch if ch.isalpha() else " "
+        for ch in decomposed if not unicodedata.combining(ch)
+    )
+
+def soundex(token: str) -> str:
+    """American Soundex of an already folded token (``jones`` → ``J520``)"""
+    code = token[0].upper()
+    last = _SOUNDEX_CODES.get(token[0], "")
+    for ch in token[1:]:
+        digit = _SOUNDEX_CODES.get(ch, "")
+        if digit and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        # h and w do not separate letters with the same code
+        if ch not in "hw":
+            last = digit
+    return code.ljust(4, "0")
+
+def name_keys(name: str) -> list:
+    return sorted({soundex(t) for t in fold_name(name).split()})
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        previous = current
+    return previous[-1]
+
+def refresh_name_keys(conn: sqlite3.Connection, batch_size: int = 10000) -> int:
+    """Compute phonetic keys for every patient that has none yet"""
+    cur = conn.execute("""
+        SELECT p.patient_id, p.patient_name FROM patients p
+        WHERE NOT EXISTS (SELECT 1 FROM patient_name_keys k WHERE k.patient_id = p.patient_id)
+    """)
+    refreshed = 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO patient_name_keys(name_key, patient_id) VALUES (?, ?)",
+                [(key, pid) for pid, name in rows for key in name_keys(name or "")]
+            )
+        refreshed += len(rows)
+    return refreshed
+
+def refresh_pending_name_keys(conn: sqlite3.Connection, batch_size: int = 10000) -> int:
+    """Compute phonetic keys for the patients queued by the insert/rename triggers.
+
+    Each batch is one IMMEDIATE transaction, so a rename cannot slip in
+    between reading a name and dequeuing it.
+    """
+    refreshed = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("""
+                SELECT q.patient_id, p.patient_name FROM patient_name_keys_pending q
+                LEFT JOIN patients p ON p.patient_id = q.patient_id LIMIT ?
+            """, (batch_size,)).fetchall()
+            conn.executemany(
+                "INSERT OR IGNORE INTO patient_name_keys(name_key, patient_id) VALUES (?, ?)",
+                [(key, pid) for pid, name in rows if name is not None for key in name_keys(name)]
+            )
+            conn.executemany("DELETE FROM patient_name_keys_pending WHERE patient_id = ?", [(pid,) for pid, _ in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        refreshed += len(rows)
+        if len(rows) < batch_size:
+            return refreshed
+
+def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = ?", (name,)
+    ).fetchone() is not None
+
+def init_db(path: str):
+    """Prepare hospital.db for serving: WAL mode plus the lookup indexes.
+
+    Safe to run on every start; everything is created only if missing.
+    Progress goes to stderr so it never mixes into an export on stdout.
+    Failures (read-only file, SQLite without FTS5) are reported and the
+    server keeps working with the slower fallbacks.
+    """
+    try:
+        conn = sqlite3.connect(path)
+    except sqlite3.Error as e:
+        print(f"⚠️  Could not open {path} for setup: {e}", file=sys.stderr)
+        return
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(LOOKUP_INDEX_SQL)
+        conn.executescript(LEGACY_NAME_INDEX_SQL)
+        if not _table_exists(conn, "patient_name_tokens"):
+            print("🔎 Building patient name index...", file=sys.stderr)
+            conn.executescript("BEGIN;" + NAME_INDEX_SQL + NAME_INDEX_BUILD_SQL + "COMMIT;")
+        conn.executescript("BEGIN;" + NAME_KEYS_SQL + "COMMIT;")
+        refreshed = refresh_pending_name_keys(conn) + refresh_name_keys(conn)
+        if refreshed:
+            print(f"🔤 Computed phonetic name keys for {refreshed} patients", file=sys.stderr)
+        if not _table_exists(conn, "patient_summary"):
+            print("📄 Building patient summaries...", file=sys.stderr)
+            conn.executescript("BEGIN;" + SUMMARY_SQL + SUMMARY_BUILD_SQL + "COMMIT;")
+    except sqlite3.Error as e:
+        print(f"⚠️  Database setup incomplete for {path}: {e}", file=sys.stderr)
+    finally:
         conn.close()
-        return {"error": f"Patient '{name_query}' not found"}
+
+class ConnectionPool:
+    """Bounded pool of long-lived read-only SQLite connections.
+
+    Connections are opened lazily up to ``size`` and handed back to an idle
+    LIFO stack after each lookup, so a busy worker thread keeps reusing the
+    same warm connection (page cache, parsed schema, prepared statements).
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._in_use = 0
+        self.hits = 0
+        self.waits = 0
+        self._initialized = False
+        self._init_lock = threading.Lock()
+        self.has_name_index = False
+        self.has_key_index = False
+        self.has_key_queue = False
+        self.has_summary = False
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+
+    def _initialize(self):
+        """Detect the optional tables once, whichever thread opens the first
+        connection. Creating them is init_db's job (server start, ``migrate``)."""
+        with self._init_lock:
+            if self._initialized:
+                return
+            conn = self._connect()
+            try:
+                self.has_name_index = _table_exists(conn, "patient_name_tokens")
+                self.has_key_index = _table_exists(conn, "patient_name_keys")
+                self.has_key_queue = _table_exists(conn, "patient_name_keys_pending")
+                self.has_summary = _table_exists(conn, "patient_summary")
+            finally:
+                conn.close()
+            self._initialized = True
+
+    def _connect(self) -> sqlite3.Connection:
+        uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _open(self) -> sqlite3.Connection:
+        if not self._initialized:
+            self._initialize()
+        return self._connect()
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+                self._in_use += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+                self._in_use += 1
+            else:
+                self.waits += 1
+
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                    self._in_use -= 1
+                raise
+
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"Connection pool exhausted ({self.size} connections busy for {self.timeout}s)"
+            )
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._idle.put(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "waits": self.waits,
+                "open_connections": self._opened,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "max_size": self.size
+            }
+
+    def data_version(self) -> int:
+        """``PRAGMA data_version`` from a dedicated connection.
+
+        The value only changes when another connection commits, so a change
+        means hospital.db was written since the previous call.
+        """
+        with self._watcher_lock:
+            if self._watcher is None:
+                self._watcher = self._open()
+            return self._watcher.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+        with self._watcher_lock:
+            if self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
+
+def parse_shards(spec: str) -> list:
+    """[(name, path)] from "name=path,..." or "path,..." (named after the file)"""
+    shards = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, path = item.partition("=")
+        if not sep:
+            name, path = Path(item).stem, item
+        shards.append((name.strip(), path.strip()))
+    return shards
+
+class ShardRouter:
+    """One connection pool per database file, with parallel fan-out.
+
+    Every lookup runs on all shards at once (one inline, the rest on a
+    shared thread pool) and the caller merges the per-shard answers. With a
+    single file this is just that file's pool, called inline.
+    """
+
+    def __init__(self, shards: list, shard_by: str = DB_SHARD_BY, pool_size: int = DB_POOL_SIZE):
+        if not shards:
+            raise ValueError("At least one patient database is required")
+        if shard_by not in ("facility", "hash"):
+            raise ValueError(f"Unknown PATIENT_DB_SHARD_BY '{shard_by}' (facility or hash)")
+        self.names = [name for name, _ in shards]
+        self.pools = [ConnectionPool(path, pool_size) for _, path in shards]
+        self.shard_by = shard_by
+        self._executor = None
+        if len(self.pools) > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=(len(self.pools) - 1) * pool_size, thread_name_prefix="patient-shard"
+            )
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.pools) > 1
+
+    def map(self, fn, shards=None) -> list:
+        """``fn(shard, pool)`` for each shard index (all by default), in parallel"""
+        shards = range(len(self.pools)) if shards is None else list(shards)
+        if not shards:
+            return []
+        futures = [self._executor.submit(fn, i, self.pools[i]) for i in shards[1:]]
+        first = fn(shards[0], self.pools[shards[0]])
+        return [first] + [f.result() for f in futures]
+
+    def shard_for_id(self, patient_id: int):
+        """Shard index holding ``patient_id`` under hash sharding, else None"""
+        if self.shard_by == "hash":
+            return patient_id % len(self.pools)
+        return None
+
+    def data_version(self) -> tuple:
+        """Per-shard data versions; changes whenever any shard is written"""
+        return tuple(pool.data_version() for pool in self.pools)
+
+    def stats(self) -> dict:
+        return {name: pool.stats() for name, pool in zip(self.names, self.pools)}
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+_router = None
+_router_lock = threading.Lock()
+
+def init_databases():
+    """init_db on every configured shard; run before serving, not per request"""
+    for pool in get_router().pools:
+        init_db(pool.path)
+
+def get_router() -> ShardRouter:
+    """Return the process-wide shard router, creating it on first use"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ShardRouter(parse_shards(DB_SHARDS) or [("default", DB_PATH)])
+    return _router
+
+# How often the server drains the phonetic-key queue (0 disables it)
+NAME_KEY_REFRESH_SECONDS = float(os.getenv("PATIENT_NAME_KEY_REFRESH_SECONDS", "5"))
+
+class NameKeyRefresher:
+    """Background thread that computes phonetic keys for patients other
+    writers have inserted or renamed, so a misspelled search finds them
+    without a restart.
+
+    It is the only place the server writes: each tick it checks the shards
+    whose data_version moved, reads the queue on the pool's read-only
+    watcher, and only then opens a writable connection. A writer holding
+    the lock delays the next tick, never a lookup.
+    """
+
+    def __init__(self, router: ShardRouter, interval: float = NAME_KEY_REFRESH_SECONDS):
+        self.router = router
+        self.interval = interval
+        self.refreshed = 0
+        self._versions = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="patient-name-keys", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self) -> int:
+        """Drain every shard's queue that may have grown; returns keys computed"""
+        refreshed = 0
+        for pool in self.router.pools:
+            try:
+                version = pool.data_version()
+                if not pool.has_key_queue or self._versions.get(pool.path) == version:
+                    continue
+                with pool._watcher_lock:
+                    pending = pool._watcher.execute(
+                        "SELECT 1 FROM patient_name_keys_pending LIMIT 1"
+                    ).fetchone() is not None
+                if pending:
+                    conn = sqlite3.connect(pool.path, isolation_level=None, timeout=DB_POOL_TIMEOUT)
+                    try:
+                        refreshed += refresh_pending_name_keys(conn)
+                    finally:
+                        conn.close()
+                # Our own commit bumps data_version, so the next tick re-reads
+                # the (now empty) queue once; that also catches rows a writer
+                # queued while we were draining
+                self._versions[pool.path] = version
+            except sqlite3.Error as e:
+                logger.warning("Could not refresh phonetic name keys for %s: %s", pool.path, e)
+        if refreshed:
+            logger.debug("Computed phonetic name keys for %d patients", refreshed)
+            self.refreshed += refreshed
+        return refreshed
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+# Record cache sizing
+PATIENT_CACHE_SIZE = int(os.getenv("PATIENT_CACHE_SIZE", "2048"))
+PATIENT_CACHE_TTL = float(os.getenv("PATIENT_CACHE_TTL", "300"))
+
+MISSING = object()
+
+class PatientCache:
+    """LRU cache of assembled patient records with a TTL.
+
+    Every read compares the database ``data_version`` with the one the
+    entries were built against and drops everything when any shard has
+    been written in the meantime. ``None`` is cached for "not found".
+    """
+
+    def __init__(self, max_size: int = PATIENT_CACHE_SIZE, ttl: float = PATIENT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def validate(self, version):
+        """Drop all entries if the database changed since they were cached"""
+        with self._lock:
+            if version != self._version:
+                if self._entries:
+                    self.invalidations += 1
+                    self._entries.clear()
+                self._version = version
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version):
+        with self._lock:
+            # Built from an older snapshot than the cache now tracks
+            if version != self._version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
+
+patient_cache = PatientCache()
+
+def _cache_key(kind: str, text: str) -> str:
+    return f"{kind}:{' '.join(text.lower().split())}"
+
+# Above this many vocabulary words for the rarest query token, matches are so
+# dense that walking patients newest-first finds one sooner than the postings
+NAME_MAX_PROBES = int(os.getenv("PATIENT_NAME_MAX_PROBES", "32"))
+
+def name_pattern(name_query: str) -> str:
+    """LIKE pattern matching every name token, in order"""
+    return '%' + '%'.join(name_query.split()) + '%'
+
+def _matching_words(conn: sqlite3.Connection, token: str) -> list:
+    """Vocabulary words containing ``token`` (LIKE semantics), with patient counts"""
+    pattern = f"%{token}%"
+    if len(token) >= 3:
+        return conn.execute("""
+            SELECT token_id, patients FROM name_tokens
+            WHERE token_id IN (SELECT rowid FROM name_token_fts WHERE token LIKE ?)
+              AND token LIKE ?
+        """, (pattern, pattern)).fetchall()
+    # Too short for trigrams: scan the vocabulary (far smaller than patients)
+    return conn.execute(
+        "SELECT token_id, patients FROM name_tokens WHERE token LIKE ?", (pattern,)
+    ).fetchall()
+
+def _name_driver(conn: sqlite3.Connection, name_query: str, use_index: bool):
+    """Vocabulary words of the query's rarest token, [] if some token matches
+    nothing, or None when the LIKE scan is the better plan."""
+    tokens = name_query.split()
+    if not use_index or not tokens or any(ch in name_query for ch in "%_"):
+        return None
     
-    meds = conn.execute("""
-        SELECT m.medication_name FROM patient_medications pm
-        JOIN medications m ON pm.med_id = m.med_id
-        WHERE pm.patient_id = ?
-    """, (row['patient_id'],)).fetchall()
-    conn.close()
+    driver = None
+    # Short tokens are rarely selective; only expand them if nothing else
+    candidates = [t for t in tokens if len(t) >= 3] or tokens
+    for token in candidates:
+        words = _matching_words(conn, token)
+        if not words:
+            return []
+        if driver is None or sum(w['patients'] for w in words) < sum(w['patients'] for w in driver):
+            driver = words
+    return None if len(driver) > NAME_MAX_PROBES else driver
+
+def _keyset_filter(after, date_column: str, id_column: str, inclusive: bool = False) -> tuple:
+    """SQL condition (and params) for rows ranked below the ``after`` key"""
+    if after is None:
+        return "1", ()
+    return f"({date_column}, {id_column}) {'<=' if inclusive else '<'} (?, ?)", after
+
+def search_names(conn: sqlite3.Connection, name_query: str, use_index: bool,
+                 limit: int, after: tuple = None, inclusive: bool = False) -> list:
+    """Patients whose name matches every token in order, latest discharge first.
+
+    Rows are ranked by (discharge_date, patient_id) descending, with missing
+    dates last. ``after`` is the key of the last row already returned, so
+    every page is a range read and page 1000 costs the same as page 1.
+    ``inclusive`` also returns the row at ``after`` itself (for shards
+    ranked behind the one the cursor came from).
+
+    Through the word index: pick the query token with the fewest postings,
+    read each vocabulary word containing it newest first and keep rows whose
+    full name matches the LIKE pattern. Wildcards in the query, very broad
+    tokens or a missing index walk the discharge-date index instead.
+    """
+    pattern = name_pattern(name_query)
+    driver = _name_driver(conn, name_query, use_index)
+    
+    if driver is None:
+        return _scan_names(conn, pattern, limit, after, inclusive)
     
+    # Postings store a missing discharge date as '', which sorts last
+    where, params = _keyset_filter(after, "t.discharge_date", "t.patient_id", inclusive)
+    rows = {}
+    for word in driver:
+        for row in conn.execute(f"""
+            SELECT t.patient_id, t.discharge_date AS sort_date, p.patient_name,
+                   p.primary_diagnosis, p.discharge_date
+            FROM patient_name_tokens t
+            JOIN patients p ON p.patient_id = t.patient_id
+            WHERE t.token_id = ? AND {where} AND p.patient_name LIKE ?
+            ORDER BY t.discharge_date DESC, t.patient_id DESC LIMIT ?
+        """, (word['token_id'], *params, pattern, limit)):
+            rows[row['patient_id']] = row
+    return sorted(rows.values(), key=lambda r: (r['sort_date'], r['patient_id']), reverse=True)[:limit]
+
+MAX_PATIENT_ID = 2**63 - 1
+
+def _scan_names(conn: sqlite3.Connection, pattern: str, limit: int, after: tuple = None,
+                inclusive: bool = False) -> list:
+    columns = "p.patient_id, COALESCE(p.discharge_date, '') AS sort_date, p.patient_name, " \
+              "p.primary_diagnosis, p.discharge_date"
+    rows = []
+    if after is None or after[0] != "":
+        where, params = _keyset_filter(after, "p.discharge_date", "p.patient_id", inclusive)
+        rows = conn.execute(f"""
+            SELECT {columns} FROM patients p
+            WHERE p.discharge_date IS NOT NULL AND {where} AND p.patient_name LIKE ?
+            ORDER BY p.discharge_date DESC, p.patient_id DESC LIMIT ?
+        """, (*params, pattern, limit)).fetchall()
+    if len(rows) < limit:
+        # Patients without a discharge date rank after everyone else
+        below = after[1] if after is not None and after[0] == "" else MAX_PATIENT_ID
+        rows += conn.execute(f"""
+            SELECT {columns} FROM patients p
+            WHERE p.discharge_date IS NULL AND p.patient_id {'<=' if inclusive else '<'} ?
+              AND p.patient_name LIKE ?
+            ORDER BY p.patient_id DESC LIMIT ?
+        """, (below, pattern, limit - len(rows))).fetchall()
+    return rows
+
+# Full patient record for every row of the ``matched`` CTE, medications
+# aggregated in SQL so one statement returns the whole document.
+RECORD_SQL = """
+    SELECT p.*, d.restriction_text AS diet, w.warning_text AS warnings,
+           (SELECT json_group_array(m.medication_name)
+              FROM patient_medications pm
+              JOIN medications m ON m.med_id = pm.med_id
+             WHERE pm.patient_id = p.patient_id) AS medications
+    FROM matched p
+    LEFT JOIN dietary_restrictions d ON p.diet_id = d.diet_id
+    LEFT JOIN warning_signs w ON p.warning_id = w.warning_id
+"""
+
+# Same rows from the stored documents, when patient_summary exists
+SUMMARY_RECORD_SQL = """
+    SELECT p.*, s.document
+    FROM matched p
+    JOIN patient_summary s ON s.patient_id = p.patient_id
+"""
+
+def record_sql(pool: "ConnectionPool") -> str:
+    return SUMMARY_RECORD_SQL if pool.has_summary else RECORD_SQL
+
+def record_from_row(row: sqlite3.Row) -> dict:
+    if "document" in row.keys():
+        return loads_json(row['document'])
     return {
         "name": row['patient_name'],
         "diagnosis": row['primary_diagnosis'],
         "discharge_date": row['discharge_date'],
-        "medications": [m['medication_name'] for m in meds],
+        "medications": json.loads(row['medications']),
         "diet": row['diet'],
         "warnings": row['warnings']
     }
 
-# THE ONLY EXTRACTOR THAT WORKS WITH REAL ACP MESSAGES
-def extract_text_from_acp(input_obj) -> str:
-    """Handles: Message → parts → MessagePart → content"""
-    text = ""
+def get_patient_full(name_query: str):
+    if not name_query or not name_query.strip():
+        return {"error": "No name provided"}
     
-    if isinstance(input_obj, list):
-        for msg in input_obj:
-            if hasattr(msg, 'parts') and msg.parts:
-                for part in msg.parts:
-                    if hasattr(part, 'content') and part.content:
-                        text += str(part.content) + " "
+    router = get_router()
+    version = router.data_version()
+    patient_cache.validate(version)
+    key = _cache_key("name", name_query)
+    record = patient_cache.get(key)
+    if record is MISSING:
+        record = _fetch_patient(router, name_query)
+        patient_cache.put(key, record, version)
     
-    elif hasattr(input_obj, 'parts') and input_obj.parts:
-        for part in input_obj.parts:
-            if hasattr(part, 'content') and part.content:
-                text += str(part.content) + " "
+    if record is None:
+        return {"error": f"Patient '{name_query}' not found"}
+    return record
+
+def _fetch_patient(router: "ShardRouter", name_query: str):
+    found = _best(router.map(lambda shard, pool: _names_in_shard(router, shard, pool, [(0, name_query)])))
+    if 0 not in found:
+        found = _best(router.map(lambda shard, pool: _phonetic_in_shard(router, shard, pool, [(0, name_query)])))
+    return found.get(0)
+
+def _best(shard_results: list) -> dict:
+    """Merge per-shard {idx: (rank, record)} maps, keeping the highest rank"""
+    best = {}
+    for found in shard_results:
+        for idx, (rank, record) in found.items():
+            if idx not in best or rank > best[idx][0]:
+                best[idx] = (rank, record)
+    return {idx: record for idx, (rank, record) in best.items()}
+
+def _shard_record(router: "ShardRouter", shard: int, record: dict, patient_id: int,
+                  matched_by: str = None) -> dict:
+    if matched_by:
+        record["matched_by"] = matched_by
+    if router.sharded:
+        record["shard"] = router.names[shard]
+        record["patient_id"] = patient_id
+    return record
+
+def _fetch_records(conn: sqlite3.Connection, pool: ConnectionPool, resolved: list) -> list:
+    """[(idx, patient_id, record)] for [{"idx", "id"}], in one statement.
+
+    Straight primary-key probes on patient_summary; databases without it
+    assemble the records from the source tables.
+    """
+    if pool.has_summary:
+        rows = conn.execute("""
+            SELECT json_extract(t.value, '$.idx') AS idx, s.patient_id, s.document
+            FROM json_each(?) t
+            JOIN patient_summary s ON s.patient_id = json_extract(t.value, '$.id')
+        """, (json.dumps(resolved),)).fetchall()
+    else:
+        rows = conn.execute(f"""
+            WITH matched AS (
+                SELECT json_extract(t.value, '$.idx') AS idx, p.*
+                FROM json_each(?) t
+                JOIN patients p ON p.patient_id = json_extract(t.value, '$.id')
+            )
+            {RECORD_SQL}
+        """, (json.dumps(resolved),)).fetchall()
+    return [(row['idx'], row['patient_id'], record_from_row(row)) for row in rows]
+
+RESOLVE_NAMES_SQL = """
+WITH terms AS (
+    SELECT json_extract(value, '$[0]') AS idx, json_extract(value, '$[1]') AS token_id,
+           json_extract(value, '$[2]') AS pattern
+    FROM json_each(?)
+),
+hits AS MATERIALIZED (
+    SELECT idx, CASE WHEN token_id IS NULL THEN (
+        SELECT p.patient_id FROM patients p
+        WHERE p.patient_name LIKE terms.pattern
+        ORDER BY p.discharge_date DESC, p.patient_id DESC LIMIT 1
+    ) ELSE (
+        SELECT t.patient_id FROM patient_name_tokens t
+        JOIN patients p ON p.patient_id = t.patient_id
+        WHERE t.token_id = terms.token_id AND p.patient_name LIKE terms.pattern
+        ORDER BY t.discharge_date DESC, t.patient_id DESC LIMIT 1
+    ) END AS patient_id
+    FROM terms
+)
+SELECT idx, patient_id FROM (
+    SELECT h.idx, h.patient_id, ROW_NUMBER() OVER (
+        PARTITION BY h.idx ORDER BY COALESCE(p.discharge_date, '') DESC, h.patient_id DESC
+    ) AS pick
+    FROM hits h JOIN patients p ON p.patient_id = h.patient_id
+) WHERE pick = 1
+"""
+
+def _resolve_names(conn: sqlite3.Connection, pool: ConnectionPool, names: list) -> list:
+    """Best match (latest discharge) for every (idx, name) term in one statement.
+
+    Same matches as ``search_names(..., limit=1)``: each name is probed through
+    the vocabulary words of its rarest token, or by LIKE scan when the word
+    index cannot help; the statement takes the newest hit per name.
+    """
+    terms = []
+    for idx, name_query in names:
+        pattern = name_pattern(name_query)
+        driver = _name_driver(conn, name_query, pool.has_name_index)
+        if driver is None:
+            terms.append([idx, None, pattern])
+        else:
+            terms.extend([idx, word['token_id'], pattern] for word in driver)
+    if not terms:
+        return []
+    return [{"idx": row['idx'], "id": row['patient_id']}
+            for row in conn.execute(RESOLVE_NAMES_SQL, (json.dumps(terms),))]
+
+def _names_in_shard(router: "ShardRouter", shard: int, pool: ConnectionPool, names: list, ids: list = ()) -> dict:
+    """{idx: (rank, record)} for the (idx, name) and (idx, patient_id) terms found in one shard.
+
+    Ranks order candidates across shards: latest discharge, then highest
+    patient_id, then the earlier shard.
+    """
+    with pool.connection() as conn:
+        resolved = _resolve_names(conn, pool, names)
+        for idx, patient_id in ids:
+            if router.shard_for_id(patient_id) in (None, shard):
+                resolved.append({"idx": idx, "id": patient_id})
+        if not resolved:
+            return {}
+        records = _fetch_records(conn, pool, resolved)
+    return {
+        idx: ((record['discharge_date'] or "", patient_id, -shard), _shard_record(router, shard, record, patient_id))
+        for idx, patient_id, record in records
+    }
+
+def _phonetic_in_shard(router: "ShardRouter", shard: int, pool: ConnectionPool, names: list) -> dict:
+    """Typo-tolerant second chance for (idx, name) terms the exact match missed"""
+    found = {}
+    with pool.connection() as conn:
+        for idx, name_query in names:
+            match = _phonetic_match(pool, conn, name_query)
+            if match:
+                distance, patient_id = match
+                for _, _, record in _fetch_records(conn, pool, [{"idx": idx, "id": patient_id}]):
+                    rank = (-distance, record['discharge_date'] or "", patient_id, -shard)
+                    found[idx] = (rank, _shard_record(router, shard, record, patient_id, matched_by="phonetic"))
+    return found
+
+SEARCH_PAGE_SIZE = int(os.getenv("PATIENT_SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("PATIENT_SEARCH_MAX_PAGE_SIZE", "100"))
+
+def encode_cursor(row, shard: int = 0) -> str:
+    """Opaque page cursor: the (discharge_date, patient_id, shard) key of the last row"""
+    return f"{row['sort_date']}|{row['patient_id']}|{shard}"
+
+def decode_cursor(cursor: str) -> tuple:
+    date, patient_id, shard = cursor.rsplit("|", 2)
+    return (date, int(patient_id)), int(shard)
+
+def search_patients(name_query: str, limit: int = SEARCH_PAGE_SIZE, cursor: str = None) -> dict:
+    """One page of every patient matching ``name_query``, latest discharge first.
+
+    Every shard returns its own next page and the pages are merged on the
+    (discharge_date, patient_id) key, ties going to the earlier shard. Pass
+    the returned ``next_cursor`` back to get the following page; it is None
+    on the last page.
+    """
+    if not name_query or not name_query.strip():
+        return {"error": "No name provided"}
+    limit = max(1, min(int(limit), SEARCH_MAX_PAGE_SIZE))
+    try:
+        after, after_shard = decode_cursor(cursor) if cursor else (None, -1)
+    except ValueError:
+        return {"error": f"Invalid cursor '{cursor}'"}
+    
+    def page_in_shard(shard, pool):
+        with pool.connection() as conn:
+            # One extra row tells whether another page exists
+            rows = search_names(conn, name_query, pool.has_name_index, limit + 1, after,
+                                inclusive=shard > after_shard)
+        return [(shard, row) for row in rows]
+    
+    router = get_router()
+    rows = [item for rows in router.map(page_in_shard) for item in rows]
+    rows.sort(key=lambda item: (item[1]['sort_date'], item[1]['patient_id'], -item[0]), reverse=True)
+    page = rows[:limit]
+    
+    results = []
+    for shard, row in page:
+        result = {
+            "patient_id": row['patient_id'],
+            "name": row['patient_name'],
+            "diagnosis": row['primary_diagnosis'],
+            "discharge_date": row['discharge_date']
+        }
+        if router.sharded:
+            result["shard"] = router.names[shard]
+        results.append(result)
+    return {
+        "query": name_query,
+        "results": results,
+        "next_cursor": encode_cursor(page[-1][1], page[-1][0]) if len(rows) > limit else None
+    }
+
+def parse_search_request(payload: Payload) -> dict:
+    """Accept {"query": ..., "limit": ..., "cursor": ...} or a bare name"""
+    data = payload.structured()
+    if isinstance(data, dict):
+        return {
+            "name_query": str(data.get("query") or data.get("name") or ""),
+            "limit": data.get("limit") or SEARCH_PAGE_SIZE,
+            "cursor": data.get("cursor")
+        }
+    return {"name_query": payload.text, "limit": SEARCH_PAGE_SIZE, "cursor": None}
+
+FUZZY_CANDIDATES = int(os.getenv("PATIENT_FUZZY_CANDIDATES", "200"))
+FUZZY_MAX_DISTANCE = int(os.getenv("PATIENT_FUZZY_MAX_DISTANCE", "2"))
+
+def _phonetic_match(pool: ConnectionPool, conn: sqlite3.Connection, name_query: str):
+    """Closest patient by phonetic key, for names the exact match missed.
+
+    Candidates sharing every query token's Soundex code come straight from
+    the key index; they are ranked by per-token edit distance, then by the
+    latest discharge. Returns (distance, patient_id) or None.
+    """
+    if not pool.has_key_index:
+        return None
+    query_tokens = fold_name(name_query).split()
+    keys = name_keys(name_query)
+    if not keys:
+        return None
     
-    elif hasattr(input_obj, 'content'):
-        text = str(input_obj.content)
+    placeholders = ",".join("?" * len(keys))
+    candidates = conn.execute(f"""
+        SELECT p.patient_id, p.patient_name, p.discharge_date
+        FROM patients p
+        WHERE p.patient_id IN (
+            SELECT patient_id FROM patient_name_keys
+            WHERE name_key IN ({placeholders})
+            GROUP BY patient_id HAVING COUNT(*) = ?
+        )
+        ORDER BY p.discharge_date DESC
+        LIMIT ?
+    """, (*keys, len(keys), FUZZY_CANDIDATES)).fetchall()
     
-    return text.strip()
+    best = None
+    for cand in candidates:
+        name_tokens = fold_name(cand['patient_name'] or "").split()
+        distance = sum(min(edit_distance(q, t) for t in name_tokens) for q in query_tokens)
+        if distance > FUZZY_MAX_DISTANCE * len(query_tokens):
+            continue
+        # Candidates arrive latest-discharge first, so ties keep the earlier one
+        if best is None or distance < best[0]:
+            best = (distance, cand['patient_id'])
+    return best
+
+MAX_BATCH_SIZE = int(os.getenv("PATIENT_MAX_BATCH_SIZE", "200"))
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+def parse_patient_list(payload: Payload) -> list:
+    """Accept a JSON array (or {"patients": [...]}) or one name/ID per line or
+    semicolon. Commas are left alone: "Jones, Sarah" is one name.
+    Raises ValueError for JSON of any other shape."""
+    data = payload.structured()
+    if data is None:
+        return [item.strip() for item in payload.text.replace(";", "\n").splitlines() if item.strip()]
+    if isinstance(data, dict):
+        data = data.get("patients") or data.get("names") or data.get("ids")
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON list of names/IDs or {"patients": [...]}')
+    return data
+
+def get_patients_batch(queries: list) -> list:
+    """Resolve many names or patient IDs with one record fetch per shard.
+
+    Each query is matched exactly like ``get_patient_full`` (numeric values
+    are treated as patient IDs). Results come back in input order, with a
+    per-item ``error`` for anything that did not resolve.
+    """
+    router = get_router()
+    version = router.data_version()
+    patient_cache.validate(version)
+    results = [None] * len(queries)
+    keys = [None] * len(queries)
+    names = []
+    ids = []
+    for idx, query in enumerate(queries):
+        text = str(query).strip() if query is not None else ""
+        if not text:
+            results[idx] = {"query": query, "error": "No name provided"}
+            continue
+        # isdecimal, not isdigit: "²" is a digit but int() rejects it
+        is_id = text.isdecimal()
+        if is_id and int(text) > SQLITE_MAX_INT:
+            results[idx] = {"query": query, "error": f"Invalid patient ID '{query}'"}
+            continue
+        keys[idx] = _cache_key("id" if is_id else "name", text)
+        record = patient_cache.get(keys[idx])
+        if record is not MISSING:
+            results[idx] = {"query": query, "record": record}
+        elif is_id:
+            ids.append((idx, int(text)))
+        else:
+            names.append((idx, text))
+
+    if names or ids:
+        shards = None
+        if not names and router.shard_by == "hash":
+            shards = sorted({router.shard_for_id(patient_id) for _, patient_id in ids})
+        found = _best(router.map(lambda shard, pool: _names_in_shard(router, shard, pool, names, ids), shards))
+        
+        missed = [(idx, text) for idx, text in names if idx not in found]
+        if missed:
+            found.update(_best(router.map(lambda shard, pool: _phonetic_in_shard(router, shard, pool, missed))))
+        
+        for idx, _ in names + ids:
+            record = found.get(idx)
+            patient_cache.put(keys[idx], record, version)
+            results[idx] = {"query": queries[idx], "record": record}
+
+    for idx, query in enumerate(queries):
+        result = results[idx]
+        if "record" in result:
+            record = result.pop("record")
+            if record is None:
+                result["error"] = f"Patient '{query}' not found"
+            else:
+                result["patient"] = record
+    return results
+
+# Cohort export streams rows off a cursor in batches of this size, so memory
+# stays flat however large the cohort is.
+EXPORT_BATCH_SIZE = int(os.getenv("PATIENT_EXPORT_BATCH_SIZE", "1000"))
+
+def cohort_filter(diagnosis: str = None, discharged_from: str = None, discharged_to: str = None) -> tuple:
+    """WHERE clause (and params) for a cohort; dates are inclusive ISO days"""
+    clauses, params = [], []
+    if diagnosis:
+        clauses.append("p.primary_diagnosis = ? COLLATE NOCASE")
+        params.append(diagnosis)
+    if discharged_from:
+        clauses.append("p.discharge_date >= ?")
+        params.append(discharged_from)
+    if discharged_to:
+        # Also covers discharge dates stored with a time of day
+        clauses.append("p.discharge_date < date(?, '+1 day')")
+        params.append(discharged_to)
+    return " AND ".join(clauses) or "1", params
+
+def _cohort_keyset(after: tuple) -> tuple:
+    """Rows after (discharge_date, patient_id) in export order; '' is a
+    missing date, which sorts first"""
+    date, patient_id = after
+    if date == "":
+        return "(p.discharge_date IS NOT NULL OR p.patient_id > ?)", [patient_id]
+    return "(p.discharge_date, p.patient_id) > (?, ?)", [date, patient_id]
+
+def iter_cohort(diagnosis: str = None, discharged_from: str = None, discharged_to: str = None,
+                batch_size: int = EXPORT_BATCH_SIZE, after: tuple = None):
+    """Yield full records (with medications) for every matching patient.
+
+    One shard at a time, in discharge order. Each shard is read through a
+    single cursor with fetchmany, so only one batch is ever in memory and
+    the export sees a consistent snapshot of that shard. ``after`` is the
+    (shard, discharge_date, patient_id) of the last record already sent.
+    """
+    where, params = cohort_filter(diagnosis, discharged_from, discharged_to)
+    router = get_router()
+    for shard, pool in enumerate(router.pools):
+        shard_where, shard_params = where, params
+        if after is not None:
+            if shard < after[0]:
+                continue
+            if shard == after[0]:
+                keyset, keyset_params = _cohort_keyset(after[1:])
+                shard_where, shard_params = f"{where} AND {keyset}", params + keyset_params
+        with pool.connection() as conn:
+            cursor = conn.execute(f"""
+                WITH matched AS (SELECT * FROM patients p WHERE {shard_where})
+                {record_sql(pool)}
+                ORDER BY p.discharge_date, p.patient_id
+            """, shard_params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        record = _shard_record(router, shard, record_from_row(row), row['patient_id'])
+                        record["patient_id"] = row['patient_id']
+                        record["_key"] = (shard, row['discharge_date'] or "", row['patient_id'])
+                        yield record
+            finally:
+                cursor.close()
+
+def iter_ndjson(records, batch_size: int = EXPORT_BATCH_SIZE):
+    """Group records into NDJSON chunks of up to ``batch_size`` lines"""
+    lines = []
+    for record in records:
+        lines.append(dumps_json(record))
+        if len(lines) >= batch_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+def export_cohort(out, diagnosis: str = None, discharged_from: str = None, discharged_to: str = None) -> int:
+    """Write a cohort to the text stream ``out`` as NDJSON; returns the row count"""
+    count = 0
+    for record in iter_cohort(diagnosis, discharged_from, discharged_to):
+        del record["_key"]
+        out.write(dumps_json(record) + "\n")
+        count += 1
+    return count
+
+# The ExportCohort agent answers one page per request: acp_sdk keeps every
+# part a run yields (run output, session history), so an unbounded stream
+# would grow server memory with the cohort. Whole cohorts go through the
+# `python recept.py export` CLI, which stays flat.
+EXPORT_PAGE_SIZE = int(os.getenv("PATIENT_EXPORT_PAGE_SIZE", "10000"))
+
+def encode_cohort_cursor(key: tuple) -> str:
+    shard, date, patient_id = key
+    return f"{date}|{patient_id}|{shard}"
+
+def decode_cohort_cursor(cursor: str) -> tuple:
+    date, patient_id, shard = cursor.rsplit("|", 2)
+    return int(shard), date, int(patient_id)
+
+def cohort_page(diagnosis: str = None, discharged_from: str = None, discharged_to: str = None,
+                cursor: str = None, limit: int = EXPORT_PAGE_SIZE) -> dict:
+    """Up to ``limit`` cohort records after ``cursor``, and the cursor of the
+    next page (None on the last one)"""
+    limit = max(1, min(int(limit), EXPORT_PAGE_SIZE))
+    after = decode_cohort_cursor(cursor) if cursor else None
+    records, more = [], False
+    rows = iter_cohort(diagnosis, discharged_from, discharged_to,
+                       batch_size=min(EXPORT_BATCH_SIZE, limit + 1), after=after)
+    try:
+        for record in rows:
+            if len(records) == limit:
+                more = True
+                break
+            records.append(record)
+    finally:
+        rows.close()
+    next_cursor = encode_cohort_cursor(records[-1]["_key"]) if more else None
+    for record in records:
+        del record["_key"]
+    return {"records": records, "next_cursor": next_cursor}
+
+def parse_cohort_request(payload: Payload) -> dict:
+    """Accept {"diagnosis": ..., "from": ..., "to": ..., "cursor": ..., "limit": ...}
+    or a bare diagnosis"""
+    data = payload.structured()
+    if isinstance(data, dict):
+        return {
+            "diagnosis": data.get("diagnosis"),
+            "discharged_from": data.get("from"),
+            "discharged_to": data.get("to"),
+            "cursor": data.get("cursor"),
+            "limit": data.get("limit") or EXPORT_PAGE_SIZE
+        }
+    return {"diagnosis": payload.text or None, "discharged_from": None, "discharged_to": None,
+            "cursor": None, "limit": EXPORT_PAGE_SIZE}
+
+# Blocking database work runs on a bounded thread pool so the ACP event loop
+# stays free; beyond PATIENT_DB_MAX_QUEUE waiting lookups we shed load.
+DB_WORKERS = int(os.getenv("PATIENT_DB_WORKERS", str(DB_POOL_SIZE)))
+DB_MAX_QUEUE = int(os.getenv("PATIENT_DB_MAX_QUEUE", "1000"))
+
+class ServerBusy(Exception):
+    pass
+
+class DbExecutor:
+    """Bounded thread pool for blocking lookups, with queue-depth metrics"""
+
+    def __init__(self, workers: int = DB_WORKERS, max_queue: int = DB_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="patient-db")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.peak_queue = 0
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise ServerBusy(f"Patient server busy ({self.queued} lookups queued)")
+            self.queued += 1
+            self.peak_queue = max(self.peak_queue, self.queued)
+
+        def task():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        def cancelled_before_start(future):
+            # A cancelled future never ran task(), so it still counts as queued
+            if future.cancelled():
+                with self._lock:
+                    self.queued -= 1
+
+        future = self._executor.submit(task)
+        future.add_done_callback(cancelled_before_start)
+        # Cancelling the awaiting coroutine (client gone) cancels the pending future
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self.queued,
+                "peak_queue_depth": self.peak_queue,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "max_queue": self.max_queue
+            }
+
+db_executor = DbExecutor()
 
 @server.agent(name="GetPatient")
-def patient_agent(input: any, context):
-    print(f"Raw input type: {type(input)}")
+async def patient_agent(input: any, context):
+    logger.debug("Raw input type: %s", type(input))
     
-    query = extract_text_from_acp(input)
-    print(f"Extracted query: '{query}'")
+    payload = decode_input(input)
+    query = payload.text
+    logger.debug("Extracted query: '%s'", query)
     
+    content_type = payload.accept
     if not query:
-        return json.dumps({"error": "Empty input received"}, indent=2)
+        return encode_part({"error": "Empty input received"}, content_type)
     
-    result = get_patient_full(query)
-    return json.dumps(result, indent=2, ensure_ascii=False)
+    try:
+        result = await db_executor.run(get_patient_full, query)
+    except ServerBusy as e:
+        result = {"error": str(e)}
+    return encode_part(result, content_type)
 
-if __name__ == "__main__":
+@server.agent(name="GetPatients")
+async def patients_batch_agent(input: any, context):
+    """Batch lookup: a list of names/IDs in, an ordered list of records out"""
+    payload = decode_input(input)
+    content_type = payload.accept
+    try:
+        queries = parse_patient_list(payload)
+    except ValueError as e:
+        return encode_part({"error": str(e)}, content_type)
+    if not queries:
+        return encode_part({"error": "Empty input received"}, content_type)
+    if len(queries) > MAX_BATCH_SIZE:
+        return encode_part({"error": f"Too many patients requested ({len(queries)} > {MAX_BATCH_SIZE})"}, content_type)
+    
+    try:
+        results = await db_executor.run(get_patients_batch, queries)
+    except ServerBusy as e:
+        return encode_part({"error": str(e)}, content_type)
+    return encode_part({
+        "results": results,
+        "requested": len(queries),
+        "found": sum(1 for r in results if "patient" in r)
+    }, content_type)
+
+@server.agent(name="SearchPatients")
+async def search_patients_agent(input: any, context):
+    """Every matching patient, a page at a time (id, name, diagnosis, discharge date)"""
+    payload = decode_input(input)
+    content_type = payload.accept
+    request = parse_search_request(payload)
+    if not request["name_query"]:
+        return encode_part({"error": "Empty input received"}, content_type)
+    
+    try:
+        result = await db_executor.run(
+            search_patients, request["name_query"], request["limit"], request["cursor"]
+        )
+    except ServerBusy as e:
+        result = {"error": str(e)}
+    except (TypeError, ValueError):
+        result = {"error": f"Invalid limit '{request['limit']}'"}
+    return encode_part(result, content_type)
+
+@server.agent(name="ExportCohort")
+async def export_cohort_agent(input: any, context):
+    """One page of the patients with a diagnosis and/or discharge window, as
+    NDJSON parts, then {"count", "next_cursor"}; send the cursor back for the
+    next page. Large exports: python recept.py export"""
+    payload = decode_input(input)
+    content_type = payload.accept
+    request = parse_cohort_request(payload)
+    if not any(request[key] for key in ("diagnosis", "discharged_from", "discharged_to")):
+        yield encode_part({"error": "Give a diagnosis and/or a from/to discharge window"}, content_type)
+        return
+    
+    try:
+        page = await db_executor.run(lambda: cohort_page(**request))
+    except ServerBusy as e:
+        yield encode_part({"error": str(e)}, content_type)
+        return
+    except (TypeError, ValueError):
+        yield encode_part({"error": f"Invalid cursor or limit ({request['cursor']!r}, {request['limit']!r})"}, content_type)
+        return
+    for chunk in iter_ndjson(page["records"]):
+        yield MessagePart(content=chunk, content_type=NDJSON_CONTENT_TYPE)
+    yield encode_part({"count": len(page["records"]), "next_cursor": page["next_cursor"]}, content_type)
+
+@server.agent(name="PatientStats")
+def patient_stats(input: any, context):
+    """Report pool, cache and executor usage for capacity planning"""
+    return encode_part({
+        "shards": get_router().stats(),
+        "cache": patient_cache.stats(),
+        "executor": db_executor.stats()
+    }, negotiate(input))
+
+def main():
+    parser = argparse.ArgumentParser(description="Patient database server")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("serve", help="Run the ACP server on port 8003 (default)")
+    sub.add_parser("migrate", help="Create the lookup indexes and tables, then exit")
+    export = sub.add_parser("export", help="Stream a patient cohort as NDJSON")
+    export.add_argument("--diagnosis", help="Primary diagnosis (case-insensitive exact match)")
+    export.add_argument("--from", dest="discharged_from", help="First discharge day (YYYY-MM-DD)")
+    export.add_argument("--to", dest="discharged_to", help="Last discharge day (YYYY-MM-DD)")
+    export.add_argument("--output", "-o", help="File to write (default: stdout)")
+    export.add_argument("--db", help="Database to read (default: DB_PATH / PATIENT_DB_SHARDS)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        if args.db:
+            global DB_PATH
+            DB_PATH = args.db
+        started = time.perf_counter()
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as out:
+                count = export_cohort(out, args.diagnosis, args.discharged_from, args.discharged_to)
+        else:
+            count = export_cohort(sys.stdout, args.diagnosis, args.discharged_from, args.discharged_to)
+        print(f"✅ Exported {count:,} patients in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        return
+
+    # Migrations (index builds can take minutes on a large DB) finish before
+    # the first request, so no lookup waits behind them
+    started = time.perf_counter()
+    init_databases()
+    if args.command == "migrate":
+        print(f"✅ Databases ready in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        return
+
+    NameKeyRefresher(get_router()).start()
     print("PATIENT SERVER v4 (REAL ACP MESSAGE HANDLER) → http://localhost:8003")
-    server.run(port=8003)
\ No newline at end of file
+    server.run(port=8003)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
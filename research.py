@@ -1,16 +1,26 @@
 
-import json
 import time
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import List, Dict, Optional
 from dataclasses import dataclass
 
+import httpx
+import requests
 from openai import AzureOpenAI
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
 from acp_sdk.server import Server
-from acp_sdk.models import Message, MessagePart
+from acp_sdk.models import MessagePart
+
+from caches import EmbeddingCache, EmbeddingStore, WebResultCache, web_query_key
+from codec import TEXT_CONTENT_TYPE, Payload, decode_input, encode_part, negotiate
+from context_builder import REPLY_PRIMING, count_tokens, dedupe_chunks, message_tokens, pack_chunks, pack_history, prompt_budget
+from local_index import LocalIndex, rerank
+from web_decision import WEB_TRIGGERS, WebDecider, WebDecisionModel
 
 # === WEB SEARCH (Google SERP) ===
 try:
@@ -47,6 +57,65 @@ GPT_MODEL = os.getenv("GPT_MODEL", "gpt-4o-08-06")
 
 # SerpAPI
 SERPAPI_KEY = os.getenv("SERPAPI_KEY")
+
+class Config:
+    """Settings shared by every request (environment / .env)"""
+    AZURE_SEARCH_ENDPOINT = AZURE_SEARCH_ENDPOINT
+    AZURE_SEARCH_INDEX = AZURE_SEARCH_INDEX
+    AZURE_SEARCH_KEY = AZURE_SEARCH_KEY
+    AZURE_OPENAI_ENDPOINT = AZURE_OPENAI_ENDPOINT
+    AZURE_OPENAI_KEY = AZURE_OPENAI_KEY
+    API_VERSION = API_VERSION
+    EMBEDDING_MODEL = EMBEDDING_MODEL
+    GPT_MODEL = GPT_MODEL
+    SERPAPI_KEY = SERPAPI_KEY
+    
+    # Keep-alive HTTP pools reused by every chat turn (per Azure endpoint)
+    HTTP_MAX_CONNECTIONS = int(os.getenv("AZURE_HTTP_MAX_CONNECTIONS", "32"))
+    HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv("AZURE_HTTP_KEEPALIVE_CONNECTIONS", "16"))
+    HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AZURE_HTTP_KEEPALIVE_EXPIRY", "120"))
+    HTTP_TIMEOUT = float(os.getenv("AZURE_HTTP_TIMEOUT", "60"))
+    
+    # Textbook retrieval: "azure" (AI Search) or "local" (memory-mapped index, see local_index.py)
+    RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "azure")
+    LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "textbook_index")
+    LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+    # "vector" or "hybrid" (BM25 + vector fused by reciprocal rank, reranked locally)
+    RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector")
+    RERANK_TERM_WEIGHT = float(os.getenv("RERANK_TERM_WEIGHT", "0.3"))
+    
+    # On-disk caches live here unless their own path is set; created on first use
+    CACHE_DIR = os.getenv("CHAT_CACHE_DIR", ".cache")
+    
+    # Embedding cache: in-memory LRU over a SQLite file that survives restarts
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(CACHE_DIR, "embedding_cache.db"))
+    EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", "100000"))
+    
+    # How long a session reuses its textbook retrieval before searching again
+    TEXTBOOK_CONTEXT_TTL = float(os.getenv("TEXTBOOK_CONTEXT_TTL", "1800"))
+    
+    # Threads for the concurrent retrieval stages (up to 3 per chat turn)
+    RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "16"))
+    
+    # SerpAPI results on disk, keyed by disease + sorted query terms
+    WEB_CACHE_PATH = os.getenv("WEB_CACHE_PATH", os.path.join(CACHE_DIR, "web_cache.db"))
+    WEB_CACHE_TTL = float(os.getenv("WEB_CACHE_TTL", "86400"))
+    WEB_CACHE_MAX_ENTRIES = int(os.getenv("WEB_CACHE_MAX_ENTRIES", "10000"))
+    
+    # Prompt assembly: token budget for everything sent with the question
+    MAX_ANSWER_TOKENS = int(os.getenv("MAX_ANSWER_TOKENS", "800"))
+    PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+    PROMPT_HISTORY_SHARE = float(os.getenv("PROMPT_HISTORY_SHARE", "0.25"))
+    PROMPT_WEB_SHARE = float(os.getenv("PROMPT_WEB_SHARE", "0.3"))
+    DEDUPE_THRESHOLD = float(os.getenv("DEDUPE_THRESHOLD", "0.8"))
+    
+    # Local web-search decision model; the LLM is only asked below the threshold
+    WEB_DECISION_MODEL = os.getenv("WEB_DECISION_MODEL", "web_decision_model.json")
+    WEB_DECISION_THRESHOLD = float(os.getenv("WEB_DECISION_THRESHOLD", "0.8"))
+    WEB_DECISION_LLM_FALLBACK = os.getenv("WEB_DECISION_LLM_FALLBACK", "1") == "1"
+    # Opt-in decision log for retraining (hashed features and labels, no question text)
+    WEB_DECISION_LOG = os.getenv("WEB_DECISION_LOG", "")
 # ============================================================================
 # DATA STRUCTURES
 # ============================================================================
@@ -58,6 +127,9 @@ class ConversationContext:
     conversation_history: List[Dict] = None
     textbook_context: Optional[str] = None
     last_search_time: float = 0
+    textbook_result: Optional[Dict] = None
+    textbook_disease: Optional[str] = None
+    textbook_query: Optional[str] = None
     
     def __post_init__(self):
         if self.conversation_history is None:
@@ -70,53 +142,177 @@ conversations: Dict[str, ConversationContext] = {}
 # AZURE CLIENTS
 # ============================================================================
 
-def initialize_clients():
-    """Initialize Azure OpenAI and Search clients"""
-    openai_client = AzureOpenAI(
-        api_key=Config.AZURE_OPENAI_KEY,
-        api_version=Config.API_VERSION,
-        azure_endpoint=Config.AZURE_OPENAI_ENDPOINT
-    )
+class AzureClients:
+    """Long-lived Azure OpenAI and Search clients with their own HTTP pools.
+
+    Both SDK clients are thread-safe, so one instance serves every chat
+    turn and keeps its TCP/TLS connections alive between requests.
+    """
     
-    search_client = SearchClient(
-        endpoint=Config.AZURE_SEARCH_ENDPOINT,
-        index_name=Config.AZURE_SEARCH_INDEX,
-        credential=AzureKeyCredential(Config.AZURE_SEARCH_KEY)
-    )
+    def __init__(self):
+        self.openai_requests = 0
+        self.search_requests = 0
+        self._count_lock = threading.Lock()
+        
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=Config.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.HTTP_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=Config.HTTP_TIMEOUT,
+            event_hooks={"request": [self._count_openai]}
+        )
+        self.openai = AzureOpenAI(
+            api_key=Config.AZURE_OPENAI_KEY,
+            api_version=Config.API_VERSION,
+            azure_endpoint=Config.AZURE_OPENAI_ENDPOINT,
+            http_client=self.http_client
+        )
+        
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=Config.HTTP_MAX_CONNECTIONS,
+            pool_block=False
+        )
+        self.session.mount("https://", adapter)
+        self.session.hooks["response"].append(self._count_search)
+        # The local backend needs no Azure AI Search settings at all
+        self.search = None if Config.RETRIEVAL_BACKEND == "local" else SearchClient(
+            endpoint=Config.AZURE_SEARCH_ENDPOINT,
+            index_name=Config.AZURE_SEARCH_INDEX,
+            credential=AzureKeyCredential(Config.AZURE_SEARCH_KEY),
+            transport=RequestsTransport(session=self.session, session_owner=False)
+        )
     
-    return openai_client, search_client
+    def _count_openai(self, request):
+        with self._count_lock:
+            self.openai_requests += 1
+    
+    def _count_search(self, response, *args, **kwargs):
+        with self._count_lock:
+            self.search_requests += 1
+    
+    def stats(self) -> Dict:
+        """Connection reuse per endpoint: requests served vs connections opened"""
+        openai_pool = {"requests": self.openai_requests}
+        pool = getattr(getattr(self.http_client, "_transport", None), "_pool", None)
+        if pool is not None:
+            connections = list(pool.connections)
+            openai_pool["open_connections"] = len(connections)
+            openai_pool["idle_connections"] = sum(1 for c in connections if c.is_idle())
+        openai_pool["max_connections"] = Config.HTTP_MAX_CONNECTIONS
+        
+        # urllib3 counts every connection it had to open; reuse keeps this flat
+        search_pool = {"requests": self.search_requests, "connections_opened": 0}
+        for adapter in self.session.adapters.values():
+            for host_pool in adapter.poolmanager.pools.values():
+                search_pool["connections_opened"] += host_pool.num_connections
+        search_pool["max_connections"] = Config.HTTP_MAX_CONNECTIONS
+        
+        return {"openai": openai_pool, "search": search_pool}
+    
+    def close(self):
+        self.http_client.close()
+        self.session.close()
+
+_clients: Optional[AzureClients] = None
+_clients_lock = threading.Lock()
+
+def get_clients() -> AzureClients:
+    """Return the process-wide Azure clients, creating them on first use"""
+    global _clients
+    if _clients is None:
+        with _clients_lock:
+            if _clients is None:
+                _clients = AzureClients()
+    return _clients
+
+embedding_cache = EmbeddingCache(
+    max_size=Config.EMBEDDING_CACHE_SIZE,
+    store=EmbeddingStore(Config.EMBEDDING_CACHE_PATH, Config.EMBEDDING_CACHE_MAX_ROWS)
+    if Config.EMBEDDING_CACHE_PATH else None
+)
 
 def generate_embeddings(text: str, client) -> List[float]:
-    """Generate embeddings for semantic search"""
-    return client.embeddings.create(
-        input=[text],
-        model=Config.EMBEDDING_MODEL
-    ).data[0].embedding
+    """Generate embeddings for semantic search (cached per model and normalized text)"""
+    def embed(text):
+        return client.embeddings.create(
+            input=[text],
+            model=Config.EMBEDDING_MODEL
+        ).data[0].embedding
+    
+    return embedding_cache.get_or_compute(Config.EMBEDDING_MODEL, text, embed)
 
 # ============================================================================
 # DATABASE SEARCH (TEXTBOOK RAG)
 # ============================================================================
 
-def search_textbook(disease: str, search_client, openai_client) -> Dict:
-    """Search nephrology textbook using vector similarity"""
+_local_index: Optional[LocalIndex] = None
+_local_index_lock = threading.Lock()
+
+def get_local_index() -> LocalIndex:
+    """The memory-mapped textbook index, opened on first use"""
+    global _local_index
+    if _local_index is None:
+        with _local_index_lock:
+            if _local_index is None:
+                _local_index = LocalIndex(Config.LOCAL_INDEX_PATH, nprobe=Config.LOCAL_INDEX_NPROBE)
+                print(f"📚 Local textbook index: {_local_index.count:,} chunks")
+    return _local_index
+
+def vector_search(embeddings: List[float], search_client, k: int = 8):
+    """Top-k textbook documents (id, content, page, chapter) from the configured backend"""
+    if Config.RETRIEVAL_BACKEND == "local":
+        return get_local_index().search(embeddings, k)
+    
+    vector_query = VectorizedQuery(
+        vector=embeddings, 
+        k_nearest_neighbors=k, 
+        fields="contentVector"
+    )
+    
+    return search_client.search(
+        search_text=None,
+        vector_queries=[vector_query],
+        top=k
+    )
+
+def hybrid_search(embeddings: List[float], text: str, search_client, k: int = 8):
+    """Top-k textbook documents by keyword (BM25) and vector rank, fused and
+    reranked on query-term coverage. Still one index query per call."""
+    if Config.RETRIEVAL_BACKEND == "local":
+        return get_local_index().hybrid_search(embeddings, text, k, term_weight=Config.RERANK_TERM_WEIGHT)
+    
+    # Azure fuses the BM25 and vector rankings itself (RRF); rerank its top 2k here
+    vector_query = VectorizedQuery(
+        vector=embeddings, 
+        k_nearest_neighbors=2 * k, 
+        fields="contentVector"
+    )
+    results = search_client.search(
+        search_text=text,
+        vector_queries=[vector_query],
+        top=2 * k
+    )
+    candidates = [dict(result, fused=1.0 / (60 + rank)) for rank, result in enumerate(results, 1)]
+    return rerank(candidates, text, k, Config.RERANK_TERM_WEIGHT)
+
+def search_textbook(disease: str, search_client, openai_client, query_text: Optional[str] = None) -> Dict:
+    """Search nephrology textbook using vector similarity, plus keywords from
+    ``query_text`` when RETRIEVAL_MODE is hybrid"""
     try:
         print(f"📚 Searching textbook for: {disease}")
         
         # Generate query embedding
         embeddings = generate_embeddings(disease, openai_client)
         
-        # Perform vector search
-        vector_query = VectorizedQuery(
-            vector=embeddings, 
-            k_nearest_neighbors=8, 
-            fields="contentVector"
-        )
-        
-        results = search_client.search(
-            search_text=None,
-            vector_queries=[vector_query],
-            top=8
-        )
+        # Perform vector (or hybrid) search
+        if Config.RETRIEVAL_MODE == "hybrid" and query_text:
+            results = hybrid_search(embeddings, query_text, search_client, k=8)
+        else:
+            results = vector_search(embeddings, search_client, k=8)
         
         # Collect and format results
         chunks = []
@@ -149,6 +345,7 @@ def search_textbook(disease: str, search_client, openai_client) -> Dict:
         return {
             "found": bool(chunks),
             "context": combined_text,
+            "chunks": chunks,
             "sources": sources,
             "num_chunks": len(chunks)
         }
@@ -162,10 +359,77 @@ def search_textbook(disease: str, search_client, openai_client) -> Dict:
             "error": str(e)
         }
 
+textbook_reuse = {"hits": 0, "misses": 0}
+
+def get_textbook_context(conv: ConversationContext, disease: str, search_client, openai_client,
+                         user_message: str = ""):
+    """Session's textbook retrieval for ``disease``, re-searched only when the
+    disease changes or the result is older than TEXTBOOK_CONTEXT_TTL.
+    In hybrid mode the question's keywords are part of the query, so a new
+    question searches again. Returns (result, hit)."""
+    query_text = f"{disease} {user_message}".strip() if Config.RETRIEVAL_MODE == "hybrid" else None
+    fresh = time.time() - conv.last_search_time < Config.TEXTBOOK_CONTEXT_TTL
+    if (conv.textbook_result is not None and conv.textbook_disease == disease
+            and conv.textbook_query == query_text and fresh):
+        textbook_reuse["hits"] += 1
+        return conv.textbook_result, True
+    
+    textbook_reuse["misses"] += 1
+    result = search_textbook(disease, search_client, openai_client, query_text)
+    # Failed searches are retried next turn rather than reused
+    if "error" not in result:
+        conv.textbook_result = result
+        conv.textbook_disease = disease
+        conv.textbook_query = query_text
+        conv.textbook_context = result.get("context")
+        conv.last_search_time = time.time()
+    return result, False
+
 # ============================================================================
 # WEB SEARCH (Google via SerpAPI)
 # ============================================================================
 
+web_cache = WebResultCache(
+    Config.WEB_CACHE_PATH, ttl=Config.WEB_CACHE_TTL, max_entries=Config.WEB_CACHE_MAX_ENTRIES
+) if Config.WEB_CACHE_PATH else None
+
+def fetch_web_results(query: str, disease: str) -> List[Dict]:
+    """Top organic SerpAPI results (title, snippet, link) for a medical query"""
+    # Build medical-focused search query
+    search_query = f"{disease} {query} site:nih.gov OR site:mayoclinic.org OR site:uptodate.com OR site:nejm.org OR site:kdigo.org"
+    
+    params = {
+        "q": search_query,
+        "api_key": Config.SERPAPI_KEY,
+        "num": 6,
+        "gl": "us",
+        "hl": "en"
+    }
+    
+    search = GoogleSearch(params)
+    results = search.get_dict()
+    # Raised rather than returned so failures are never cached
+    if results.get("error"):
+        raise RuntimeError(results["error"])
+    
+    return [
+        {
+            "title": result.get("title", "No title"),
+            "snippet": result.get("snippet", ""),
+            "link": result.get("link", "")
+        }
+        for result in results.get("organic_results", [])[:5]
+    ]
+
+def format_web_context(disease: str, snippets: List[str]) -> str:
+    return f"""[WEB SEARCH RESULTS - {disease.upper()}]
+Based on latest information from medical websites (as of November 2025):
+
+{"".join(snippets)}
+
+⚠️ Always verify with your healthcare provider.
+"""
+
 def search_web(query: str, disease: str) -> Dict:
     """Search Google for latest medical information using SerpAPI"""
     if not SERP_AVAILABLE:
@@ -177,41 +441,38 @@ def search_web(query: str, disease: str) -> Dict:
         }
     
     try:
-        print(f"🌐 Searching web for: {query}")
-        
-        # Build medical-focused search query
-        search_query = f"{disease} {query} site:nih.gov OR site:mayoclinic.org OR site:uptodate.com OR site:nejm.org OR site:kdigo.org"
-        
-        params = {
-            "q": search_query,
-            "api_key": Config.SERPAPI_KEY,
-            "num": 6,
-            "gl": "us",
-            "hl": "en"
-        }
-        
-        search = GoogleSearch(params)
-        results = search.get_dict()
-        
-        organic_results = results.get("organic_results", [])
+        # Near-identical questions ("CKD latest guidelines", "latest CKD guidelines") share an entry
+        key = web_query_key(query, disease)
+        organic_results = web_cache.get(key) if web_cache else None
+        cached = organic_results is not None
+        if cached:
+            print(f"🌐 Web results from cache for: {query}")
+        else:
+            print(f"🌐 Searching web for: {query}")
+            organic_results = fetch_web_results(query, disease)
+            if web_cache:
+                web_cache.put(key, organic_results)
         
         if not organic_results:
             return {
                 "found": False,
                 "context": "No reliable medical sources found on the web.",
-                "sources": []
+                "sources": [],
+                "cached": cached
             }
         
         # Format results
+        chunks = []
         snippets = []
         sources = []
         
-        for idx, result in enumerate(organic_results[:5]):
-            title = result.get("title", "No title")
-            snippet = result.get("snippet", "")
-            link = result.get("link", "")
+        for idx, result in enumerate(organic_results):
+            title = result["title"]
+            snippet = result["snippet"]
+            link = result["link"]
             
-            snippets.append(f"[{idx+1}] {title}\n{snippet}\nSource: {link}\n")
+            chunks.append(f"{title}\n{snippet}\nSource: {link}\n")
+            snippets.append(f"[{idx+1}] {chunks[-1]}")
             sources.append({
                 "type": "web",
                 "title": title,
@@ -219,18 +480,12 @@ def search_web(query: str, disease: str) -> Dict:
                 "snippet": snippet[:200]
             })
         
-        web_context = f"""[WEB SEARCH RESULTS - {disease.upper()}]
-Based on latest information from medical websites (as of November 2025):
-
-{"".join(snippets)}
-
-⚠️ Always verify with your healthcare provider.
-"""
-        
         return {
             "found": True,
-            "context": web_context,
-            "sources": sources
+            "context": format_web_context(disease, snippets),
+            "chunks": chunks,
+            "sources": sources,
+            "cached": cached
         }
         
     except Exception as e:
@@ -246,15 +501,20 @@ Based on latest information from medical websites (as of November 2025):
 # AI RESPONSE GENERATION
 # ============================================================================
 
-def generate_response(
+TEXTBOOK_SEPARATOR = "\n\n---\n\n"
+
+def build_messages(
     user_message: str,
-    textbook_context: Optional[str],
-    web_context: Optional[str],
+    textbook_chunks: List[str],
+    web_chunks: List[str],
     conversation_history: List[Dict],
-    disease: str,
-    openai_client
-) -> str:
-    """Generate natural, contextual response using GPT-4"""
+    disease: str
+):
+    """Chat completion messages under the model's prompt token budget, and the
+    tokens each section used. Chunks arrive in rank order and are only ever
+    included whole; duplicates are dropped first."""
+    model = Config.GPT_MODEL
+    budget = prompt_budget(model, Config.PROMPT_TOKEN_BUDGET, Config.MAX_ANSWER_TOKENS)
     
     # Build system prompt
     system_prompt = f"""You are a friendly, knowledgeable nephrology assistant helping patients understand their kidney condition: {disease}.
@@ -273,31 +533,68 @@ Guidelines:
 - Never diagnose or prescribe
 """
     
+    question = f"\n\n### PATIENT'S QUESTION:\n{user_message}\n\nPlease provide a helpful, patient-friendly answer."
+    usage = {
+        "system": message_tokens(system_prompt, model),
+        "question": message_tokens(question, model) + REPLY_PRIMING
+    }
+    available = max(0, budget - usage["system"] - usage["question"])
+    
+    # Recent conversation history (at most 6 messages, newest kept first)
+    history, usage["history"] = pack_history(
+        conversation_history[-6:], int(available * Config.PROMPT_HISTORY_SHARE), model
+    )
+    available -= usage["history"]
+    
+    textbook_chunks, textbook_duplicates = dedupe_chunks(textbook_chunks, threshold=Config.DEDUPE_THRESHOLD)
+    web_chunks, web_duplicates = dedupe_chunks(web_chunks, seen=textbook_chunks, threshold=Config.DEDUPE_THRESHOLD)
+    
+    # Web results get a capped share; what they leave goes to the textbook
+    web_heading = "\n### LATEST WEB INFORMATION:\n" + format_web_context(disease, [])
+    web_fixed = count_tokens(web_heading, model)
+    web_kept, web_used, web_skipped = pack_chunks(
+        web_chunks, int(available * Config.PROMPT_WEB_SHARE) - web_fixed, model, overhead=3
+    )
+    usage["web"] = web_used + web_fixed if web_kept else 0
+    available -= usage["web"]
+    
+    textbook_heading = "\n### MEDICAL TEXTBOOK INFORMATION:\n\n"
+    textbook_fixed = count_tokens(textbook_heading, model)
+    textbook_kept, textbook_used, textbook_skipped = pack_chunks(
+        textbook_chunks, available - textbook_fixed, model, overhead=3
+    )
+    usage["textbook"] = textbook_used + textbook_fixed if textbook_kept else 0
+    
     # Build context section
     context_section = ""
-    if textbook_context:
-        context_section += f"\n### MEDICAL TEXTBOOK INFORMATION:\n{textbook_context[:3000]}\n"
+    if textbook_kept:
+        context_section += f"\n### MEDICAL TEXTBOOK INFORMATION:\n{TEXTBOOK_SEPARATOR.join(textbook_kept)}\n"
     
-    if web_context:
-        context_section += f"\n### LATEST WEB INFORMATION:\n{web_context[:2000]}\n"
+    if web_kept:
+        snippets = [f"[{idx+1}] {chunk}" for idx, chunk in enumerate(web_kept)]
+        context_section += f"\n### LATEST WEB INFORMATION:\n{format_web_context(disease, snippets)}\n"
     
-    # Build conversation history
     messages = [{"role": "system", "content": system_prompt}]
+    messages.extend(history)
+    messages.append({"role": "user", "content": context_section + question})
     
-    # Add recent conversation history (last 6 messages)
-    for msg in conversation_history[-6:]:
-        messages.append(msg)
-    
-    # Add current query with context
-    user_prompt = f"{context_section}\n\n### PATIENT'S QUESTION:\n{user_message}\n\nPlease provide a helpful, patient-friendly answer."
-    messages.append({"role": "user", "content": user_prompt})
-    
+    usage["total"] = sum(usage.values())
+    usage["budget"] = budget
+    usage["chunks_used"] = {"textbook": len(textbook_kept), "web": len(web_kept)}
+    usage["chunks_dropped"] = {
+        "duplicate": textbook_duplicates + web_duplicates,
+        "over_budget": textbook_skipped + web_skipped
+    }
+    return messages, usage
+
+def generate_response(messages: List[Dict], openai_client) -> str:
+    """Generate natural, contextual response using GPT-4"""
     try:
         response = openai_client.chat.completions.create(
             model=Config.GPT_MODEL,
             messages=messages,
             temperature=0.7,
-            max_tokens=800
+            max_tokens=Config.MAX_ANSWER_TOKENS
         )
         
         return response.choices[0].message.content.strip()
@@ -306,28 +603,36 @@ Guidelines:
         print(f"❌ AI generation error: {e}")
         return f"I'm having trouble generating a response right now. Please try again. (Error: {str(e)})"
 
+def stream_response(messages: List[Dict], openai_client):
+    """Same answer as generate_response, yielded as completion deltas while they arrive"""
+    try:
+        stream = openai_client.chat.completions.create(
+            model=Config.GPT_MODEL,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=Config.MAX_ANSWER_TOKENS,
+            stream=True
+        )
+        for chunk in stream:
+            # Azure sends content-filter chunks with no choices
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        
+    except Exception as e:
+        print(f"❌ AI generation error: {e}")
+        yield f"I'm having trouble generating a response right now. Please try again. (Error: {str(e)})"
+
 # ============================================================================
 # DETERMINE IF WEB SEARCH IS NEEDED
 # ============================================================================
 
-def should_search_web(user_message: str, textbook_found: bool, openai_client) -> bool:
-    """Use AI to determine if web search would be helpful"""
-    
-    # Obvious triggers
-    web_triggers = [
-        "latest", "recent", "new", "current", "today", "2024", "2025",
-        "guidelines", "study", "research", "treatment options",
-        "side effects", "medications", "drugs"
-    ]
-    
-    if any(trigger in user_message.lower() for trigger in web_triggers):
-        return True
-    
-    # If textbook has nothing, definitely search web
-    if not textbook_found:
-        return True
-    
-    # Use AI to decide for ambiguous cases
+def web_keyword_trigger(user_message: str) -> bool:
+    """Obvious cases for web search, decided without any network call"""
+    message = user_message.lower()
+    return any(trigger in message for trigger in WEB_TRIGGERS)
+
+def llm_needs_web(user_message: str, openai_client) -> bool:
+    """Ask the model whether the question needs information newer than a textbook"""
     try:
         decision_prompt = f"""Does this patient question require current/recent medical information that might not be in a standard textbook?
 
@@ -348,75 +653,141 @@ Answer with just 'YES' or 'NO'."""
     except:
         return False  # Default to no web search if AI check fails
 
+def load_web_decider() -> WebDecider:
+    """Trained model when there is one, otherwise the shipped default (keywords
+    plus the bundled labelled examples)"""
+    model = None
+    if Config.WEB_DECISION_MODEL and os.path.exists(Config.WEB_DECISION_MODEL):
+        try:
+            model = WebDecisionModel.load(Config.WEB_DECISION_MODEL)
+            print(f"🧠 Web decision model: {Config.WEB_DECISION_MODEL}")
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Could not load {Config.WEB_DECISION_MODEL}: {e}")
+    return WebDecider(
+        model or WebDecisionModel.default(),
+        threshold=Config.WEB_DECISION_THRESHOLD,
+        log_path=Config.WEB_DECISION_LOG or None
+    )
+
+web_decider = load_web_decider()
+
+def needs_web(user_message: str, openai_client) -> bool:
+    """Local model first; the LLM check only when the model is unsure"""
+    fallback = None
+    if Config.WEB_DECISION_LLM_FALLBACK:
+        fallback = lambda text: llm_needs_web(text, openai_client)
+    need, source, p = web_decider.decide(user_message, fallback)
+    print(f"🧠 Web decision: {'YES' if need else 'NO'} ({source}, p={p:.2f})")
+    return need
+
+def should_search_web(user_message: str, textbook_found: bool, openai_client) -> bool:
+    """Use AI to determine if web search would be helpful"""
+    if web_keyword_trigger(user_message):
+        return True
+    
+    # If textbook has nothing, definitely search web
+    if not textbook_found:
+        return True
+    
+    # Local model (LLM only when unsure) for ambiguous cases
+    return needs_web(user_message, openai_client)
+
 # ============================================================================
-# INPUT EXTRACTION
+# RETRIEVAL PIPELINE
 # ============================================================================
 
-def extract_message_content(input_obj) -> Optional[str]:
-    """Extract text from various ACP input formats"""
+retrieval_executor = ThreadPoolExecutor(max_workers=Config.RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+def _run_stage(timings: Dict, name: str, started: float, fn, *args):
+    """Run one pipeline stage, recording its start/end offsets in ms"""
+    stage_start = time.perf_counter()
     try:
-        if isinstance(input_obj, str):
-            return input_obj.strip()
-        
-        if isinstance(input_obj, list):
-            for item in input_obj:
-                if hasattr(item, 'parts') and item.parts:
-                    for part in item.parts:
-                        if hasattr(part, 'content'):
-                            return str(part.content).strip()
-        
-        if hasattr(input_obj, 'parts') and input_obj.parts:
-            for part in input_obj.parts:
-                if hasattr(part, 'content'):
-                    return str(part.content).strip()
-        
-        if hasattr(input_obj, 'content'):
-            return str(input_obj.content).strip()
-        
-        # Try JSON parsing
-        if isinstance(input_obj, dict):
-            return input_obj.get('message') or input_obj.get('question') or input_obj.get('content')
-        
-        return str(input_obj).strip()
-        
-    except Exception as e:
-        print(f"❌ Input extraction error: {e}")
-        return None
+        return fn(*args)
+    finally:
+        timings[name] = {
+            "start_ms": round((stage_start - started) * 1000, 1),
+            "end_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
 
-# ============================================================================
-# MAIN CHATBOT AGENT
-# ============================================================================
+def retrieve_context(conv: ConversationContext, disease: str, user_message: str,
+                     search_client, openai_client) -> Dict:
+    """Textbook retrieval and the web-search decision run concurrently;
+    web search starts as soon as either the keywords, an empty textbook
+    result or the model says it is needed.
 
-@server.agent(name="NephrologyChat")
-def nephrology_chatbot(input: any, context) -> str:
+    Same decision as should_search_web, but the wall time is the longest
+    dependency chain instead of the sum of every call.
     """
-    Interactive nephrology chatbot that:
-    1. Searches textbook database
-    2. Uses web search when needed
-    3. Maintains conversation context
-    4. Provides patient-friendly responses
-    """
-    
-    print("\n" + "="*80)
-    print("🩺 NEPHROLOGY CHATBOT - Processing Query")
-    print("="*80)
+    started = time.perf_counter()
+    timings = {}
     
-    start_time = time.time()
+    textbook_future = retrieval_executor.submit(
+        _run_stage, timings, "textbook", started,
+        get_textbook_context, conv, disease, search_client, openai_client, user_message
+    )
+    decision_future = None
+    need_web, trigger = None, None
+    if web_keyword_trigger(user_message):
+        need_web, trigger = True, "keyword"
+    else:
+        decision_future = retrieval_executor.submit(
+            _run_stage, timings, "web_decision", started,
+            needs_web, user_message, openai_client
+        )
     
-    # Extract user message
-    user_message = extract_message_content(input)
-    if not user_message:
-        return json.dumps({
-            "error": "Could not understand input. Please send a text message.",
-            "status": "error"
-        }, indent=2)
+    while need_web is None:
+        wait([f for f in (textbook_future, decision_future) if not f.done()], return_when=FIRST_COMPLETED)
+        textbook_found = textbook_future.result()[0]["found"] if textbook_future.done() else None
+        llm_says = decision_future.result() if decision_future.done() else None
+        if textbook_found is False:
+            need_web, trigger = True, "textbook"
+        elif llm_says:
+            need_web, trigger = True, "web_decision"
+        elif textbook_found and llm_says is False:
+            need_web = False
     
-    print(f"💬 User: {user_message}")
+    web_result = None
+    if need_web:
+        web_result = _run_stage(timings, "web_search", started, search_web, user_message, disease)
+    textbook_result, textbook_hit = textbook_future.result()
+    # Snapshot: a web decision that was no longer needed may still be running
+    timings = dict(timings)
     
-    # Initialize clients
-    openai_client, search_client = initialize_clients()
+    # The stage that finished last, preceded by the one that started it
+    last = max(timings, key=lambda name: timings[name]["end_ms"])
+    critical_path = [trigger, last] if last == "web_search" and trigger in timings else [last]
     
-    # Get or create conversation context
+    return {
+        "textbook": textbook_result,
+        "textbook_hit": textbook_hit,
+        "web": web_result,
+        "need_web": need_web,
+        "web_trigger": trigger,
+        "timings": timings,
+        "critical_path": critical_path,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+# ============================================================================
+# INPUT EXTRACTION
+# ============================================================================
+
+def extract_message_content(payload: Payload) -> Optional[str]:
+    """User message from a decoded ACP input: its text, or message/question/content of a JSON body"""
+    if payload.text:
+        return payload.text
+    data = payload.structured()
+    if isinstance(data, dict):
+        message = data.get('message') or data.get('question') or data.get('content')
+        return str(message).strip() if message else None
+    return None
+
+# ============================================================================
+# CHAT TURN
+# ============================================================================
+
+def get_conversation(context, user_message: str) -> ConversationContext:
+    """Session state for this request, with its disease set on the first turn"""
     session_id = context.get('session_id', 'default') if hasattr(context, 'get') else 'default'
     
     if session_id not in conversations:
@@ -426,8 +797,7 @@ def nephrology_chatbot(input: any, context) -> str:
     
     # Extract disease if mentioned (simple keyword extraction)
     # In production, use NER or more sophisticated extraction
-    disease = conv.disease
-    if not disease:
+    if not conv.disease:
         # Try to detect disease from message
         common_conditions = [
             "chronic kidney disease", "CKD", "acute kidney injury", "AKI",
@@ -436,81 +806,190 @@ def nephrology_chatbot(input: any, context) -> str:
         ]
         for condition in common_conditions:
             if condition.lower() in user_message.lower():
-                disease = condition
-                conv.disease = disease
+                conv.disease = condition
                 break
         
-        if not disease:
-            disease = "kidney disease"  # Default
-            conv.disease = disease
+        if not conv.disease:
+            conv.disease = "kidney disease"  # Default
+    
+    return conv
+
+def prepare_turn(conv: ConversationContext, user_message: str, clients: AzureClients) -> Dict:
+    """Retrieval for one turn, plus the contexts and sources the answer is built from"""
+    # Textbook search and web decision concurrently, web search as soon as needed
+    retrieval = retrieve_context(conv, conv.disease, user_message, clients.search, clients.openai)
+    textbook_result = retrieval["textbook"]
+    sources = list(textbook_result.get("sources", []))
+    
+    print(f"📚 Textbook: {'Found' if textbook_result['found'] else 'Not found'} ({textbook_result.get('num_chunks', 0)} chunks, "
+          f"{'reused' if retrieval['textbook_hit'] else 'searched'})")
+    
+    web_context = None
+    if retrieval["need_web"]:
+        web_result = retrieval["web"]
+        web_context = web_result.get("context")
+        sources.extend(web_result.get("sources", []))
+        print(f"🌐 Web Search: {'Used' if web_result['found'] else 'Failed'} (triggered by {retrieval['web_trigger']})")
+    else:
+        print("🌐 Web Search: Not needed")
+    
+    retrieval["sources"] = sources
+    retrieval["textbook_chunks"] = textbook_result.get("chunks", [])
+    retrieval["web_chunks"] = retrieval["web"].get("chunks", []) if web_context else []
+    retrieval["web_context"] = web_context
+    return retrieval
+
+def turn_messages(conv: ConversationContext, user_message: str, turn: Dict) -> List[Dict]:
+    """Prompt for generate_response / stream_response (token usage kept on the turn)"""
+    messages, turn["prompt_tokens"] = build_messages(
+        user_message, turn["textbook_chunks"], turn["web_chunks"], conv.conversation_history, conv.disease
+    )
+    usage = turn["prompt_tokens"]
+    print(f"🧾 Prompt: {usage['total']}/{usage['budget']} tokens (textbook {usage['textbook']}, web {usage['web']}, "
+          f"history {usage['history']}; dropped {usage['chunks_dropped']})")
+    return messages
+
+def finish_turn(conv: ConversationContext, user_message: str, response_text: str, turn: Dict,
+                generate_start: float, start_time: float) -> Dict:
+    """Record the exchange in the session and build the response metadata"""
+    timings = turn["timings"]
+    timings["generate"] = {
+        "start_ms": turn["elapsed_ms"],
+        "end_ms": round(turn["elapsed_ms"] + (time.perf_counter() - generate_start) * 1000, 1)
+    }
+    print(f"⏱️  Critical path: {' → '.join(turn['critical_path'] + ['generate'])} "
+          f"(retrieval {turn['elapsed_ms']}ms)")
+    
+    # Update conversation history
+    conv.conversation_history.append({"role": "user", "content": user_message})
+    conv.conversation_history.append({"role": "assistant", "content": response_text})
+    
+    # Keep only last 12 messages
+    if len(conv.conversation_history) > 12:
+        conv.conversation_history = conv.conversation_history[-12:]
+    
+    sources = turn["sources"]
+    elapsed = round(time.time() - start_time, 2)
+    print(f"✅ Response generated in {elapsed}s")
+    print("="*80 + "\n")
+    
+    return {
+        "response": response_text,
+        "disease": conv.disease,
+        "sources": {
+            "textbook_chunks": turn["textbook"].get('num_chunks', 0),
+            "web_sources": len([s for s in sources if s.get('type') == 'web']),
+            "total": len(sources)
+        },
+        "web_search_used": turn["need_web"] and turn["web_context"] is not None,
+        "textbook_context": "hit" if turn["textbook_hit"] else "miss",
+        "timings_ms": timings,
+        "critical_path": turn["critical_path"] + ["generate"],
+        "prompt_tokens": turn["prompt_tokens"],
+        "conversation_length": len(conv.conversation_history),
+        "processing_time_seconds": elapsed,
+        "status": "success"
+    }
+
+def _start_request(input: any):
+    """Print the request banner and decode it; (payload, user message or None)"""
+    print("\n" + "="*80)
+    print("🩺 NEPHROLOGY CHATBOT - Processing Query")
+    print("="*80)
+    
+    payload = decode_input(input)
+    user_message = extract_message_content(payload)
+    if user_message:
+        print(f"💬 User: {user_message}")
+    return payload, user_message
+
+UNREADABLE_INPUT = {
+    "error": "Could not understand input. Please send a text message.",
+    "status": "error"
+}
+
+# ============================================================================
+# MAIN CHATBOT AGENT
+# ============================================================================
+
+@server.agent(name="NephrologyChat")
+def nephrology_chatbot(input: any, context) -> str:
+    """
+    Interactive nephrology chatbot that:
+    1. Searches textbook database
+    2. Uses web search when needed
+    3. Maintains conversation context
+    4. Provides patient-friendly responses
+    """
+    start_time = time.time()
+    payload, user_message = _start_request(input)
+    content_type = payload.accept
+    if not user_message:
+        return encode_part(UNREADABLE_INPUT, content_type)
+    
+    # Shared clients (connections stay warm across turns)
+    clients = get_clients()
+    conv = get_conversation(context, user_message)
     
     try:
-        # STEP 1: Search textbook database
-        textbook_result = search_textbook(disease, search_client, openai_client)
-        textbook_context = textbook_result.get("context")
-        sources = textbook_result.get("sources", [])
-        
-        print(f"📚 Textbook: {'Found' if textbook_result['found'] else 'Not found'} ({textbook_result.get('num_chunks', 0)} chunks)")
-        
-        # STEP 2: Decide if web search is needed
-        need_web = should_search_web(user_message, textbook_result['found'], openai_client)
-        
-        web_context = None
-        if need_web:
-            web_result = search_web(user_message, disease)
-            web_context = web_result.get("context")
-            sources.extend(web_result.get("sources", []))
-            print(f"🌐 Web Search: {'Used' if web_result['found'] else 'Failed'}")
-        else:
-            print("🌐 Web Search: Not needed")
-        
-        # STEP 3: Generate response
-        response_text = generate_response(
-            user_message=user_message,
-            textbook_context=textbook_context,
-            web_context=web_context,
-            conversation_history=conv.conversation_history,
-            disease=disease,
-            openai_client=openai_client
+        turn = prepare_turn(conv, user_message, clients)
+        generate_start = time.perf_counter()
+        response_text = generate_response(turn_messages(conv, user_message, turn), clients.openai)
+        return encode_part(
+            finish_turn(conv, user_message, response_text, turn, generate_start, start_time),
+            content_type
         )
         
-        # STEP 4: Update conversation history
-        conv.conversation_history.append({"role": "user", "content": user_message})
-        conv.conversation_history.append({"role": "assistant", "content": response_text})
-        
-        # Keep only last 12 messages
-        if len(conv.conversation_history) > 12:
-            conv.conversation_history = conv.conversation_history[-12:]
-        
-        # STEP 5: Format final response
-        elapsed = round(time.time() - start_time, 2)
-        
-        result = {
-            "response": response_text,
-            "disease": disease,
-            "sources": {
-                "textbook_chunks": textbook_result.get('num_chunks', 0),
-                "web_sources": len([s for s in sources if s.get('type') == 'web']),
-                "total": len(sources)
-            },
-            "web_search_used": need_web and web_context is not None,
-            "conversation_length": len(conv.conversation_history),
-            "processing_time_seconds": elapsed,
-            "status": "success"
-        }
-        
-        print(f"✅ Response generated in {elapsed}s")
-        print("="*80 + "\n")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return encode_part({
+            "error": str(e),
+            "status": "error",
+            "processing_time_seconds": round(time.time() - start_time, 2)
+        }, content_type)
+
+@server.agent(name="NephrologyChatStream")
+def nephrology_chatbot_stream(input: any, context):
+    """
+    NephrologyChat with the answer streamed: one text/plain part per
+    completion delta, then a single structured part with the usual metadata
+    (without "response") plus time_to_first_token_seconds.
+    """
+    start_time = time.time()
+    payload, user_message = _start_request(input)
+    content_type = payload.accept
+    if not user_message:
+        yield encode_part(UNREADABLE_INPUT, content_type)
+        return
+    
+    clients = get_clients()
+    conv = get_conversation(context, user_message)
+    
+    try:
+        turn = prepare_turn(conv, user_message, clients)
+        generate_start = time.perf_counter()
+        first_token = None
+        deltas = []
+        for delta in stream_response(turn_messages(conv, user_message, turn), clients.openai):
+            if first_token is None:
+                first_token = round(time.time() - start_time, 3)
+                print(f"⚡ First token after {first_token}s")
+            deltas.append(delta)
+            yield MessagePart(content=delta, content_type=TEXT_CONTENT_TYPE)
         
-        return json.dumps(result, indent=2, ensure_ascii=False)
+        result = finish_turn(conv, user_message, "".join(deltas).strip(), turn, generate_start, start_time)
+        # The client already has the text from the deltas
+        del result["response"]
+        result["time_to_first_token_seconds"] = first_token
+        yield encode_part(result, content_type)
         
     except Exception as e:
         print(f"❌ Error: {e}")
-        return json.dumps({
+        yield encode_part({
             "error": str(e),
             "status": "error",
             "processing_time_seconds": round(time.time() - start_time, 2)
-        }, indent=2)
+        }, content_type)
 
 # ============================================================================
 # CLEAR CONVERSATION (Optional utility endpoint)
@@ -523,9 +1002,26 @@ def clear_conversation(input: any, context) -> str:
     
     if session_id in conversations:
         del conversations[session_id]
-        return json.dumps({"message": "Conversation cleared", "status": "success"})
+        return encode_part({"message": "Conversation cleared", "status": "success"}, negotiate(input))
     
-    return json.dumps({"message": "No conversation to clear", "status": "success"})
+    return encode_part({"message": "No conversation to clear", "status": "success"}, negotiate(input))
+
+@server.agent(name="ChatStats")
+def chat_stats(input: any, context) -> str:
+    """Report Azure connection pool usage for capacity planning"""
+    return encode_part({
+        "clients": get_clients().stats() if _clients is not None else None,
+        "embedding_cache": embedding_cache.stats(),
+        "textbook_context": dict(textbook_reuse, ttl_seconds=Config.TEXTBOOK_CONTEXT_TTL),
+        "web_decision": web_decider.stats(),
+        "web_cache": web_cache.stats() if web_cache else None,
+        "retrieval": {
+            "backend": Config.RETRIEVAL_BACKEND,
+            "mode": Config.RETRIEVAL_MODE,
+            "local_index": _local_index.stats() if _local_index is not None else None
+        },
+        "sessions": len(conversations)
+    }, negotiate(input))
 
 # ============================================================================
 # SERVER STARTUP
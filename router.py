@@ -170,10 +170,11 @@ Provides a natural chatbot interface for patients
 """
 
 import asyncio
-import json
 import sys
 from acp_sdk.client import Client
-from acp_sdk.models import Message, MessagePart
+from acp_sdk.models import ErrorEvent, Message, MessagePart, MessagePartEvent, RunFailedEvent
+
+from codec import accept_part, decode_part, decode_response, dumps_json, is_text_part
 
 # === CONFIG ===
 PATIENT_SERVER = "http://localhost:8003"   # recept.py
@@ -183,12 +184,10 @@ CHATBOT_SERVER = "http://localhost:8001"   # Enhanced research.py
 # UTILITY FUNCTIONS
 # ============================================================================
 
-async def extract_text(resp):
-    """Safely extract text from any ACP response"""
+async def extract_data(resp):
+    """Safely decode any ACP response (JSON/msgpack payload, or raw text)"""
     try:
-        if not resp or not resp.output or not resp.output[0].parts:
-            return None
-        return str(resp.output[0].parts[0].content)
+        return decode_response(resp)
     except Exception as e:
         print(f"[DEBUG] Response extraction failed: {e}")
         return None
@@ -221,15 +220,20 @@ class PatientChatSession:
         try:
             resp = await client.run_sync(
                 agent="GetPatient",
-                input=[Message(parts=[MessagePart(content=name, content_type="text/plain")])]
+                input=[Message(parts=[
+                    MessagePart(content=name, content_type="text/plain"),
+                    accept_part()
+                ])]
             )
             
-            result = await extract_text(resp)
-            if not result:
+            data = await extract_data(resp)
+            if not data:
                 print("❌ No response from patient server")
                 return False
             
-            data = json.loads(result)
+            if not isinstance(data, dict):
+                print(f"❌ Unexpected response: {str(data)[:200]}")
+                return False
             
             if "error" in data:
                 print(f"❌ {data['error']}")
@@ -262,7 +266,8 @@ class PatientChatSession:
             return False
 
     async def chat(self, client: Client, user_message: str):
-        """Send message to nephrology chatbot"""
+        """Send message to nephrology chatbot, printing the answer as it streams in.
+        Returns the footer (or an error) to print after it."""
         
         # Build message payload
         if self.patient_loaded:
@@ -279,56 +284,68 @@ class PatientChatSession:
                 "message": user_message
             }
         
+        answering = False
+        
+        def begin_answer():
+            nonlocal answering
+            if not answering:
+                # Clear thinking indicator
+                print("\r" + " " * 40 + "\r", end="")
+                print("\n🩺 Nephrology AI:")
+                answering = True
+        
         try:
             # Show thinking indicator
             print("\n🤔 Nephrology AI is thinking...", end="", flush=True)
             
-            # Call chatbot
-            resp = await client.run_sync(
-                agent="NephrologyChat",
-                input=[Message(parts=[MessagePart(
-                    content=json.dumps(payload), 
-                    content_type="application/json"
-                )])]
-            )
-            
-            result = await extract_text(resp)
+            # Call chatbot: text parts are answer deltas, the last part is the metadata
+            data = None
+            async for event in client.run_stream(
+                agent="NephrologyChatStream",
+                input=[Message(parts=[
+                    MessagePart(content=dumps_json(payload), content_type="application/json"),
+                    accept_part()
+                ])]
+            ):
+                if isinstance(event, MessagePartEvent):
+                    if is_text_part(event.part):
+                        begin_answer()
+                        print(event.part.content, end="", flush=True)
+                    else:
+                        data = decode_part(event.part)
+                elif isinstance(event, RunFailedEvent):
+                    raise RuntimeError(event.run.error.message if event.run.error else "run failed")
+                elif isinstance(event, ErrorEvent):
+                    raise RuntimeError(event.error.message)
             
-            # Clear thinking indicator
-            print("\r" + " " * 40 + "\r", end="")
+            begin_answer()
             
-            if not result:
+            if not isinstance(data, dict):
                 return "❌ Sorry, I didn't get a response from the medical AI."
             
-            try:
-                data = json.loads(result)
-                
-                if data.get("status") == "error":
-                    return f"❌ Error: {data.get('error', 'Unknown error')}"
-                
-                response_text = data.get("response", "No response generated.")
-                
-                # Add metadata footer
-                sources = data.get("sources", {})
-                web_used = data.get("web_search_used", False)
-                time_taken = data.get("processing_time_seconds", 0)
-                
-                footer = f"\n\n{'─' * 80}\n"
-                footer += f"📊 Sources: {sources.get('textbook_chunks', 0)} textbook chunks"
-                
-                if web_used:
-                    footer += f" + {sources.get('web_sources', 0)} web sources"
-                
-                footer += f" | ⏱️ {time_taken}s"
-                
-                return response_text + footer
-                
-            except json.JSONDecodeError:
-                # Fallback: raw text response
-                return result[:3000]
+            if data.get("status") == "error":
+                return f"❌ Error: {data.get('error', 'Unknown error')}"
+            
+            # Metadata footer
+            sources = data.get("sources", {})
+            web_used = data.get("web_search_used", False)
+            time_taken = data.get("processing_time_seconds", 0)
+            first_token = data.get("time_to_first_token_seconds")
+            
+            footer = f"\n\n{'─' * 80}\n"
+            footer += f"📊 Sources: {sources.get('textbook_chunks', 0)} textbook chunks"
+            
+            if web_used:
+                footer += f" + {sources.get('web_sources', 0)} web sources"
+            
+            if first_token is not None:
+                footer += f" | ⚡ first token {first_token}s"
+            footer += f" | ⏱️ {time_taken}s"
+            
+            return footer
                 
         except Exception as e:
-            print("\r" + " " * 40 + "\r", end="")
+            begin_answer()
             return f"❌ Chatbot temporarily unavailable: {e}"
 
     def get_summary(self) -> str:
@@ -427,11 +444,9 @@ async def main():
                         print("\n✓ Starting fresh conversation")
                     continue
                 
-                # Send to chatbot
-                response = await session.chat(chatbot_client, user_input)
-                
-                # Display response
-                print(f"\n🩺 Nephrology AI:\n{response}")
+                # Send to chatbot (the answer is printed as it streams in)
+                footer = await session.chat(chatbot_client, user_input)
+                print(footer)
                 
             except KeyboardInterrupt:
                 print("\n\n👋 Goodbye!")
@@ -476,10 +476,11 @@ Simple, beautiful interface for the multi-agent nephrology system
 
 import streamlit as st
 import asyncio
-import json
 from datetime import datetime
 from acp_sdk.client import Client
-from acp_sdk.models import Message, MessagePart
+from acp_sdk.models import ErrorEvent, Message, MessagePart, MessagePartEvent, RunFailedEvent
+
+from codec import accept_part, decode_part, decode_response, dumps_json, is_text_part
 
 # ============================================================================
 # CONFIGURATION
@@ -632,12 +633,10 @@ if 'chat_history' not in st.session_state:
 # UTILITY FUNCTIONS
 # ============================================================================
 
-async def extract_text(resp):
-    """Extract text from ACP response"""
+async def extract_data(resp):
+    """Decode ACP response payload (JSON/msgpack, or raw text)"""
     try:
-        if not resp or not resp.output or not resp.output[0].parts:
-            return None
-        return str(resp.output[0].parts[0].content)
+        return decode_response(resp)
     except:
         return None
 
@@ -647,14 +646,18 @@ async def load_patient(name: str):
         async with Client(base_url=PATIENT_SERVER) as client:
             resp = await client.run_sync(
                 agent="GetPatient",
-                input=[Message(parts=[MessagePart(content=name, content_type="text/plain")])]
+                input=[Message(parts=[
+                    MessagePart(content=name, content_type="text/plain"),
+                    accept_part()
+                ])]
             )
             
-            result = await extract_text(resp)
-            if not result:
+            data = await extract_data(resp)
+            if not data:
                 return None, "No response from patient server"
             
-            data = json.loads(result)
+            if not isinstance(data, dict):
+                return None, f"Unexpected response: {str(data)[:200]}"
             
             if "error" in data:
                 return None, data["error"]
@@ -664,39 +667,51 @@ async def load_patient(name: str):
     except Exception as e:
         return None, str(e)
 
-async def send_message(message: str, patient_data=None):
-    """Send message to chatbot"""
+def chat_payload(message: str, patient_data=None) -> dict:
+    """Chatbot request, with the loaded patient's context when there is one"""
+    if patient_data:
+        return {
+            "message": message,
+            "disease": patient_data.get("diagnosis"),
+            "patient_name": patient_data.get("name"),
+            "medications": patient_data.get("medications", [])[:5]
+        }
+    return {"message": message}
+
+async def stream_message(message: str, patient_data=None, on_text=None):
+    """Send message to the streaming chatbot; on_text(answer so far) runs as tokens arrive"""
     try:
-        # Build payload
-        if patient_data:
-            payload = {
-                "message": message,
-                "disease": patient_data.get("diagnosis"),
-                "patient_name": patient_data.get("name"),
-                "medications": patient_data.get("medications", [])[:5]
-            }
-        else:
-            payload = {"message": message}
-        
+        text = ""
+        data = None
         async with Client(base_url=CHATBOT_SERVER) as client:
-            resp = await client.run_sync(
-                agent="NephrologyChat",
-                input=[Message(parts=[MessagePart(
-                    content=json.dumps(payload),
-                    content_type="application/json"
-                )])]
-            )
-            
-            result = await extract_text(resp)
-            if not result:
-                return None, "No response from chatbot"
-            
-            data = json.loads(result)
-            
-            if data.get("status") == "error":
-                return None, data.get("error", "Unknown error")
-            
-            return data, None
+            async for event in client.run_stream(
+                agent="NephrologyChatStream",
+                input=[Message(parts=[
+                    MessagePart(content=dumps_json(chat_payload(message, patient_data)), content_type="application/json"),
+                    accept_part()
+                ])]
+            ):
+                if isinstance(event, MessagePartEvent):
+                    # Text parts are answer deltas, the last part is the metadata
+                    if is_text_part(event.part):
+                        text += event.part.content
+                        if on_text:
+                            on_text(text)
+                    else:
+                        data = decode_part(event.part)
+                elif isinstance(event, RunFailedEvent):
+                    return None, event.run.error.message if event.run.error else "Chatbot run failed"
+                elif isinstance(event, ErrorEvent):
+                    return None, event.error.message
+        
+        if not isinstance(data, dict):
+            return None, "No response from chatbot"
+        
+        if data.get("status") == "error":
+            return None, data.get("error", "Unknown error")
+        
+        data["response"] = text.strip()
+        return data, None
             
     except Exception as e:
         return None, str(e)
@@ -887,6 +902,8 @@ with chat_container:
                     badges_html += f'<span class="source-badge">📚 {sources["textbook_chunks"]} textbook sources</span>'
                 if web_used and sources.get('web_sources', 0) > 0:
                     badges_html += f'<span class="source-badge">🌐 {sources["web_sources"]} web sources</span>'
+                if msg.get('first_token'):
+                    badges_html += f'<span class="source-badge">⚡ first token {msg["first_token"]}s</span>'
                 if time_taken > 0:
                     badges_html += f'<span class="source-badge">⏱️ {time_taken}s</span>'
                 
@@ -929,30 +946,48 @@ if user_input:
         "content": user_input
     })
     
-    # Show thinking state
-    with st.spinner("🤔 Thinking... (searching textbooks and web if needed)"):
-        # Send to chatbot
-        response_data, error = asyncio.run(
-            send_message(user_input, st.session_state.patient_data)
-        )
-        
-        if error:
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": f"❌ Error: {error}",
-                "sources": {},
-                "web_used": False,
-                "time": 0
-            })
-        else:
-            # Add bot response
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": response_data.get("response", "No response"),
-                "sources": response_data.get("sources", {}),
-                "web_used": response_data.get("web_search_used", False),
-                "time": response_data.get("processing_time_seconds", 0)
-            })
+    # Show the question and the answer as it streams in (the rerun below
+    # redraws both from the message history)
+    with chat_container:
+        st.markdown(f"""
+        <div class="chat-message user-message">
+            <strong>👤 You:</strong><br>
+            {user_input}
+        </div>
+        """, unsafe_allow_html=True)
+        answer = st.empty()
+    
+    def show_answer(text: str):
+        answer.markdown(f"""
+        <div class="chat-message bot-message">
+            <strong>🩺 Nephrology AI:</strong><br>
+            {text}
+        </div>
+        """, unsafe_allow_html=True)
+    
+    show_answer("🤔 Thinking... (searching textbooks and web if needed)")
+    response_data, error = asyncio.run(
+        stream_message(user_input, st.session_state.patient_data, lambda text: show_answer(text + " ▌"))
+    )
+    
+    if error:
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": f"❌ Error: {error}",
+            "sources": {},
+            "web_used": False,
+            "time": 0
+        })
+    else:
+        # Add bot response
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": response_data.get("response", "No response"),
+            "sources": response_data.get("sources", {}),
+            "web_used": response_data.get("web_search_used", False),
+            "time": response_data.get("processing_time_seconds", 0),
+            "first_token": response_data.get("time_to_first_token_seconds")
+        })
     
     # Rerun to show new messages
     st.rerun()
@@ -0,0 +1,76 @@
+"""
+Tests for ingest.py: re-ingesting an existing patient_id replaces that patient
+
+    python -m pytest test_ingest.py
+"""
+
+import io
+import sqlite3
+
+import pytest
+
+pytest.importorskip("acp_sdk")  # ingest imports recept, which is an ACP server
+
+from ingest import Ingester, read_records
+from recept import search_names
+
+def ingest(path, text: str, fmt: str = "ndjson") -> dict:
+    ingester = Ingester(str(path), batch_size=100)
+    try:
+        return ingester.run(read_records(io.StringIO(text), fmt))
+    finally:
+        ingester.close()
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / "hospital.db"
+    ingest(path, '{"patient_id": 1, "name": "Sarah Jones", "diagnosis": "CKD stage 3", '
+                 '"discharge_date": "2025-01-10", "medications": ["Lisinopril", "Furosemide"]}\n'
+                 '{"patient_id": 2, "name": "Tom Baker", "diagnosis": "AKI"}\n')
+    return path
+
+def test_reingest_existing_id_with_same_name(db):
+    report = ingest(db, '{"patient_id": 1, "name": "Sarah Jones", "diagnosis": "CKD stage 4", '
+                        '"discharge_date": "2025-03-01", "medications": ["Patiromer"]}\n')
+    assert report["written"] == 1
+
+    conn = sqlite3.connect(db)
+    conn.row_factory = sqlite3.Row
+    assert conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0] == 2
+    row = conn.execute("SELECT primary_diagnosis, discharge_date FROM patients WHERE patient_id = 1").fetchone()
+    assert tuple(row) == ("CKD stage 4", "2025-03-01")
+    meds = conn.execute("""
+        SELECT m.medication_name FROM patient_medications pm
+        JOIN medications m ON m.med_id = pm.med_id WHERE pm.patient_id = 1
+    """).fetchall()
+    assert [m[0] for m in meds] == ["Patiromer"]
+    # The word index follows the new discharge date, without duplicate postings
+    rows = search_names(conn, "sarah jones", use_index=True, limit=5)
+    assert [(r["patient_id"], r["discharge_date"]) for r in rows] == [(1, "2025-03-01")]
+    assert conn.execute("SELECT patients FROM name_tokens WHERE token = 'sarah'").fetchone()[0] == 1
+
+def test_reingest_existing_id_with_new_name(db):
+    ingest(db, "patient_id,name,diagnosis\n2,Tom Bakerson,AKI\n", fmt="csv")
+
+    conn = sqlite3.connect(db)
+    conn.row_factory = sqlite3.Row
+    assert conn.execute("SELECT patient_name FROM patients WHERE patient_id = 2").fetchone()[0] == "Tom Bakerson"
+    assert [r["patient_id"] for r in search_names(conn, "bakerson", use_index=True, limit=5)] == [2]
+    assert search_names(conn, "tom baker", use_index=True, limit=5)[0]["patient_name"] == "Tom Bakerson"
+    assert conn.execute("SELECT patients FROM name_tokens WHERE token = 'baker'").fetchone()[0] == 0
+    keys = {r[0] for r in conn.execute("SELECT name_key FROM patient_name_keys WHERE patient_id = 2")}
+    assert keys and conn.execute("SELECT COUNT(*) FROM patient_name_keys_pending").fetchone()[0] == 0
+
+def test_wrong_typed_records_are_skipped(db):
+    report = ingest(db, '{"name": "Ann Lee", "medications": [1, 2]}\n'
+                        '{"patient_id": [3], "name": "Bo Chan"}\n'
+                        '{"name": 123}\n'
+                        '{"patient_id": "²", "name": "Cy Dunn"}\n'
+                        '{"patient_id": 7, "name": "Di Eve"}\n'
+                        '{"patient_id": 7, "name": "Di Evans"}\n')
+    # The repeated id is one upsert, so only one row counts as written
+    assert (report["written"], report["skipped"]) == (1, 4)
+    assert [e.split(":")[0] for e in report["errors"]] == ["line 1", "line 2", "line 3", "line 4"]
+
+    conn = sqlite3.connect(db)
+    assert conn.execute("SELECT patient_name FROM patients WHERE patient_id = 7").fetchone()[0] == "Di Evans"
@@ -0,0 +1,109 @@
+"""
+Tests for recept.py name search: the word index agrees with a LIKE scan, and
+keyset pages (on one database or merged across shards) add up to the full result
+
+    python -m pytest test_recept.py
+"""
+
+import sqlite3
+
+import pytest
+
+pytest.importorskip("acp_sdk")  # recept is an ACP server
+
+import recept
+from generate_db import generate
+from recept import name_pattern, search_names, search_patients
+
+# Present in every test database, to tie across shards
+TIES = [(9001, "Tie Jones", "AKI", "2030-01-01"), (9002, "Tie Jones", "AKI", None)]
+
+QUERIES = ["jones", "sarah jones", "an", "mar li", "son", "o", "zzz", "a%b", "ñ"]
+
+def add_patients(path, rows):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO patients(patient_id, patient_name, primary_diagnosis, discharge_date) VALUES (?, ?, ?, ?)",
+            rows
+        )
+    conn.close()
+
+def like_scan(path, name_query: str) -> list:
+    """The reference answer: patient ids by plain LIKE, latest discharge first"""
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("""
+            SELECT patient_id FROM patients WHERE patient_name LIKE ?
+            ORDER BY COALESCE(discharge_date, '') DESC, patient_id DESC
+        """, (name_pattern(name_query),))]
+    finally:
+        conn.close()
+
+@pytest.fixture(scope="module")
+def hospital(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("db") / "hospital.db")
+    generate(path, patients=800, seed=3)
+    # Added after the indexes exist, so the triggers have to post them
+    add_patients(path, [
+        (5001, "Sarah Jonesy", "AKI", None),
+        (5002, "Ana Jones", "AKI", None),
+        (5003, "Mar Lindqvist", "CKD stage 2", "2025-06-01"),
+        *TIES,
+    ])
+    return path
+
+@pytest.fixture
+def router(monkeypatch):
+    """Point recept at the given database files (one shard each)"""
+    def use(*paths):
+        monkeypatch.setattr(recept, "DB_SHARDS", ",".join(f"s{i}={p}" for i, p in enumerate(paths)))
+        monkeypatch.setattr(recept, "_router", None)
+        return recept.get_router()
+    yield use
+    if recept._router is not None:
+        recept._router.close()
+
+def all_pages(name_query: str, limit: int) -> list:
+    results, cursor = [], None
+    while True:
+        page = search_patients(name_query, limit, cursor)
+        assert "error" not in page
+        results += [(r.get("shard"), r["patient_id"]) for r in page["results"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return results
+
+@pytest.mark.parametrize("name_query", QUERIES)
+def test_search_names_matches_like_scan(hospital, name_query):
+    conn = sqlite3.connect(hospital)
+    conn.row_factory = sqlite3.Row
+    expected = like_scan(hospital, name_query)
+    for use_index in (True, False):
+        rows = search_names(conn, name_query, use_index, limit=10000)
+        assert [r["patient_id"] for r in rows] == expected
+
+@pytest.mark.parametrize("name_query", ["jones", "an", "o"])
+def test_pages_add_up_to_full_result(hospital, router, name_query):
+    router(hospital)
+    expected = like_scan(hospital, name_query)
+    assert expected
+    assert [pid for _, pid in all_pages(name_query, limit=7)] == expected
+
+def test_cursor_across_shards(hospital, router, tmp_path):
+    other = str(tmp_path / "south.db")
+    generate(other, patients=500, seed=11)
+    # Facility shards reuse ids: the same (date, id) key in both shards must
+    # come back once per shard, never skipped or repeated at a page boundary
+    add_patients(other, TIES)
+    router(hospital, other)
+
+    conn = {path: sqlite3.connect(path) for path in (hospital, other)}
+    dates = {(shard, pid): conn[path].execute(
+                 "SELECT COALESCE(discharge_date, '') FROM patients WHERE patient_id = ?", (pid,)
+             ).fetchone()[0]
+             for shard, path in (("s0", hospital), ("s1", other)) for pid in like_scan(path, "jones")}
+    expected = sorted(dates, key=lambda key: (dates[key], key[1], key[0] == "s0"), reverse=True)
+
+    for limit in (1, 6, 50):
+        assert all_pages("jones", limit) == expected
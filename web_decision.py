@@ -0,0 +1,277 @@
+"""
+Local web-search decision model for the nephrology chatbot
+Hashed word n-grams and a logistic regression decide in microseconds whether a
+question needs current information from the web. The shipped model is the
+keyword list fitted on web_decision_examples.jsonl; it learns from the decisions
+logged while it runs (opt-in; the log holds hashed features and labels, never
+the question text)
+
+    python web_decision.py train --log web_decisions.jsonl --model web_decision_model.json
+"""
+
+import argparse
+import atexit
+import json
+import math
+import os
+import queue
+import random
+import re
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Questions with these words go to the web without asking anyone
+WEB_TRIGGERS = [
+    "latest", "recent", "new", "current", "today", "2024", "2025",
+    "guidelines", "study", "research", "treatment options",
+    "side effects", "medications", "drugs"
+]
+
+# Hand-labelled questions shipped with the code, so the untrained model already
+# has an opinion on the questions the keywords do not catch
+EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web_decision_examples.jsonl")
+
+HASH_DIM = 1 << 18
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def _hash(gram: str) -> int:
+    # crc32, not hash(): the model file has to mean the same thing in every process
+    return zlib.crc32(gram.encode("utf-8")) % HASH_DIM
+
+def features(text: str) -> List[int]:
+    """Hashed word unigrams and bigrams present in ``text`` (binary features)"""
+    tokens = TOKEN_RE.findall(text.lower())
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return list({_hash(gram) for gram in grams})
+
+# ============================================================================
+# MODEL
+# ============================================================================
+
+class WebDecisionModel:
+    """Sparse logistic regression over hashed n-grams"""
+
+    def __init__(self, weights: Optional[Dict[int, float]] = None, bias: float = 0.0):
+        self.weights = weights or {}
+        self.bias = bias
+
+    @classmethod
+    def from_triggers(cls, triggers: List[str] = WEB_TRIGGERS, weight: float = 6.0,
+                      bias: float = -3.0) -> "WebDecisionModel":
+        """A trigger word or phrase gives p ≈ 0.95; anything else starts at
+        p ≈ 0.05, a confident "no". Questions with no trigger word are mostly
+        textbook questions, and with bias 0 every one of them went to the
+        fallback."""
+        weights = {}
+        for trigger in triggers:
+            tokens = TOKEN_RE.findall(trigger.lower())
+            weights[_hash(" ".join(tokens))] = weight
+        return cls(weights, bias)
+
+    @classmethod
+    def default(cls, examples_path: str = EXAMPLES_PATH) -> "WebDecisionModel":
+        """The keyword model fitted on the bundled labelled examples: what runs
+        until a model trained on the decision log replaces it"""
+        model = cls.from_triggers()
+        if os.path.exists(examples_path):
+            model.fit(read_labels(examples_path))
+        return model
+
+    def probability(self, text: str) -> float:
+        """P(question needs web search)"""
+        return self.feature_probability(features(text))
+
+    def feature_probability(self, feats: Sequence[int]) -> float:
+        score = self.bias
+        weights = self.weights
+        for f in feats:
+            score += weights.get(f, 0.0)
+        return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, score))))
+
+    def fit(self, examples: List[Tuple[Sequence[int], bool]], epochs: int = 20, learning_rate: float = 0.5,
+            l2: float = 1e-4, seed: int = 0):
+        """SGD on (features, label) pairs, starting from the current weights"""
+        rng = random.Random(seed)
+        data = [(list(feats), 1.0 if label else 0.0) for feats, label in examples]
+        weights = self.weights
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate / (1 + epoch)
+            for feats, label in data:
+                score = self.bias + sum(weights.get(f, 0.0) for f in feats)
+                p = 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, score))))
+                gradient = p - label
+                self.bias -= rate * gradient
+                for f in feats:
+                    w = weights.get(f, 0.0)
+                    weights[f] = w - rate * (gradient + l2 * w)
+        return self
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"dim": HASH_DIM, "bias": self.bias, "weights": self.weights}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "WebDecisionModel":
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("dim") != HASH_DIM:
+            raise ValueError(f"{path} was trained with {data.get('dim')} features, expected {HASH_DIM}")
+        return cls({int(k): v for k, v in data["weights"].items()}, data["bias"])
+
+# ============================================================================
+# DECISIONS
+# ============================================================================
+
+class DecisionLog:
+    """Appends decision records to a JSONL file from a background thread,
+    so ``decide`` only pays for a queue put"""
+
+    def __init__(self, path: str, batch_size: int = 100):
+        self.path = path
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_loop, name="web-decision-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, record: dict):
+        self._queue.put(record)
+
+    def _write_loop(self):
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                done = True
+                batch = [record for record in batch if record is not None]
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(record) + "\n" for record in batch)
+            except OSError:
+                self.dropped += len(batch)
+
+    def close(self):
+        """Write what is queued and stop the writer"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+class WebDecider:
+    """The model's answer when it is confident, otherwise ``fallback(text)``
+    (e.g. the LLM check). With a ``log_path`` every decision is appended as
+    JSONL -- the hashed features, label, source and probability, never the
+    text; fallback answers are the labels ``train`` learns from."""
+
+    def __init__(self, model: WebDecisionModel, threshold: float = 0.8, log_path: Optional[str] = None):
+        self.model = model
+        self.threshold = threshold
+        self.log = DecisionLog(log_path) if log_path else None
+        self._lock = threading.Lock()
+        self.counts = {"model": 0, "fallback": 0}
+        self.model_seconds = 0.0
+
+    def decide(self, text: str, fallback: Optional[Callable[[str], bool]] = None) -> Tuple[bool, str, float]:
+        """(needs web, "model" or "fallback", model probability)"""
+        started = time.perf_counter()
+        feats = features(text)
+        p = self.model.feature_probability(feats)
+        elapsed = time.perf_counter() - started
+        if fallback is not None and max(p, 1 - p) < self.threshold:
+            need, source = fallback(text), "fallback"
+        else:
+            need, source = p > 0.5, "model"
+        with self._lock:
+            self.counts[source] += 1
+            self.model_seconds += elapsed
+        if self.log is not None:
+            self.log.append({
+                "ts": round(time.time(), 3), "features": sorted(feats), "label": need,
+                "source": source, "p": round(p, 4)
+            })
+        return need, source, p
+
+    def stats(self) -> dict:
+        with self._lock:
+            decisions = self.counts["model"] + self.counts["fallback"]
+            return {
+                "decisions": decisions,
+                "model": self.counts["model"],
+                "fallback": self.counts["fallback"],
+                "fallback_rate": round(self.counts["fallback"] / decisions, 4) if decisions else 0.0,
+                "threshold": self.threshold,
+                "model_us_per_decision": round(self.model_seconds / decisions * 1e6, 2) if decisions else 0.0,
+                "log_dropped": self.log.dropped if self.log is not None else None
+            }
+
+# ============================================================================
+# TRAINING
+# ============================================================================
+
+def read_labels(log_path: str, sources=("fallback", "manual")) -> List[Tuple[Tuple[int, ...], bool]]:
+    """Labelled (features, label) pairs from a decision log (the last label per
+    question wins). Hand-written "manual" lines may give "text" instead of
+    "features". The model's own decisions are skipped so it does not train
+    on itself."""
+    labels = {}
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("source") not in sources or "label" not in record:
+                continue
+            if "features" in record:
+                feats = tuple(sorted(record["features"]))
+            elif "text" in record:
+                feats = tuple(sorted(features(record["text"])))
+            else:
+                continue
+            labels[feats] = bool(record["label"])
+    return list(labels.items())
+
+def accuracy(model: WebDecisionModel, examples: List[Tuple[Sequence[int], bool]]) -> float:
+    if not examples:
+        return 0.0
+    return sum((model.feature_probability(feats) > 0.5) == label for feats, label in examples) / len(examples)
+
+def main():
+    parser = argparse.ArgumentParser(description="Web-search decision model")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train = sub.add_parser("train", help="Fit the model on a decision log")
+    train.add_argument("--log", default="web_decisions.jsonl", help="JSONL decision log")
+    train.add_argument("--examples", default=EXAMPLES_PATH, help="Labelled questions always trained on")
+    train.add_argument("--model", default="web_decision_model.json", help="Model file to write")
+    train.add_argument("--epochs", type=int, default=20)
+    train.add_argument("--holdout", type=float, default=0.2, help="Fraction kept back for evaluation")
+    train.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    examples = read_labels(args.log)
+    if not examples:
+        raise SystemExit(f"❌ No labelled decisions in {args.log}")
+    random.Random(args.seed).shuffle(examples)
+    split = int(len(examples) * (1 - args.holdout)) if len(examples) > 4 else len(examples)
+    train_set, test_set = examples[:split], examples[split:]
+
+    # The bundled examples are always trained on and never held out
+    bundled = read_labels(args.examples) if args.examples and os.path.exists(args.examples) else []
+    baseline = WebDecisionModel.default(args.examples)
+    model = WebDecisionModel.from_triggers().fit(train_set + bundled, epochs=args.epochs, seed=args.seed)
+    print(f"📚 {len(train_set)} training (+{len(bundled)} bundled) / {len(test_set)} held-out decisions")
+    if test_set:
+        print(f"🎯 Held-out accuracy: {accuracy(model, test_set):.3f} (shipped model: {accuracy(baseline, test_set):.3f})")
+    model.save(args.model)
+    print(f"✅ Saved {args.model} ({len(model.weights):,} weights)")
+
+if __name__ == "__main__":
+    main()